@@ -0,0 +1,196 @@
+import threading, time, math
+from collections import OrderedDict
+
+class Token_bucket():
+    """
+    A token bucket rate limiter that refills continuously at a fixed rate.
+
+    Attributes
+    ----------
+    rate : float
+        The number of tokens added to the bucket every second.
+    burst : float
+        The maximum number of tokens the bucket can hold.
+    tokens : float
+        The number of tokens currently in the bucket.
+
+    Methods
+    -------
+    take()
+        Removes a token from the bucket if one is available.
+    """
+    def __init__(self, rate, burst, clock=time.monotonic):
+        """
+        Parameters
+        ----------
+        rate : float
+            The number of tokens added to the bucket every second.
+        burst : float
+            The maximum number of tokens the bucket can hold, at least 1. The bucket starts full.
+        clock : function
+            Returns the current time in seconds (default is time.monotonic)
+        """
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.clock = clock
+        self.updated = clock()
+
+    def take(self):
+        """
+        Removes a token from the bucket.
+        Returns: 0 if a token was taken, otherwise the number of seconds until one will be available.
+        """
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class Admission_controller():
+    """
+    Decides whether a request should be served, queued, or rejected so that bursts of requests are shed quickly instead of timing out.
+    Requests are limited by a global token bucket, a token bucket per caller, and a bound on how many requests of each route class may be in flight.
+    Route classes are listed in priority order; a request is not admitted while a request of a higher priority class is waiting.
+
+    Attributes
+    ----------
+    priorities : tuple
+        The route classes, from highest to lowest priority.
+    class_limits : dict
+        The maximum number of requests of each route class that may be in flight.
+    max_in_flight : int
+        The maximum number of requests of any class that may be in flight.
+    separate_classes : tuple
+        The route classes limited only by their own class limit, which neither count towards nor are held back by max_in_flight.
+    queue_timeout : float
+        The longest a request will wait for an in-flight slot before being rejected.
+    max_queued : int
+        The maximum number of requests of each route class that may wait for an in-flight slot.
+
+    Methods
+    -------
+    admit()
+        Reserves an in-flight slot for a request.
+    release()
+        Frees an in-flight slot reserved by admit().
+    """
+    def __init__(self, priorities=("provisioning", "reads", "bulk"), class_limits=None, max_in_flight=4, separate_classes=(), queue_timeout=0.5, max_queued=64,
+                 global_rate=None, global_burst=None, caller_rate=None, caller_burst=None, max_callers=10000, clock=time.monotonic):
+        """
+        Parameters
+        ----------
+        priorities : tuple
+            The route classes, from highest to lowest priority. (default is provisioning, reads, bulk)
+        class_limits : dict
+            The maximum number of in-flight requests per route class. Classes not listed are limited only by max_in_flight.
+        max_in_flight : int
+            The maximum number of requests of any class that may be in flight. (default is 4)
+        separate_classes : tuple
+            Route classes limited only by class_limits, for requests that hold no database connection while in flight. (default is none)
+        queue_timeout : float
+            The latency target, in seconds, a request may wait for an in-flight slot. (default is 0.5)
+        max_queued : int
+            The maximum number of waiting requests per route class. (default is 64)
+        global_rate : float
+            Requests per second allowed across all callers, None for unlimited. (default is None)
+        global_burst : float
+            The number of requests allowed at once across all callers. (default is global_rate)
+        caller_rate : float
+            Requests per second allowed for each caller, None for unlimited. (default is None)
+        caller_burst : float
+            The number of requests allowed at once for each caller. (default is caller_rate)
+        max_callers : int
+            The number of callers to track rate limits for, the least recently seen are forgotten first. (default is 10000)
+        clock : function
+            Returns the current time in seconds (default is time.monotonic)
+        """
+        self.priorities = tuple(priorities)
+        self.class_limits = dict(class_limits or {})
+        self.max_in_flight = max_in_flight
+        self.separate_classes = tuple(separate_classes)
+        self.queue_timeout = queue_timeout
+        self.max_queued = max_queued
+        self.caller_rate = caller_rate
+        self.caller_burst = caller_burst or caller_rate
+        self.max_callers = max_callers
+        self.clock = clock
+        self.global_bucket = Token_bucket(global_rate, global_burst or global_rate, clock) if global_rate else None
+        self.caller_buckets = OrderedDict()
+        self.in_flight = {route_class: 0 for route_class in self.priorities}
+        self.waiting = {route_class: 0 for route_class in self.priorities}
+        self.condition = threading.Condition()
+
+    def admit(self, caller, route_class):
+        """
+        Applies the rate limits for the caller and waits, for at most queue_timeout, for an in-flight slot for the route class.
+        Returns: a tuple of the HTTP Code representing the result (200 when admitted, 429 or 503 when rejected) and the number of seconds the caller should wait before retrying.
+        A request that is admitted must call release() once it has been served.
+        """
+        with self.condition:
+            retry_after = self.check_rate_limits(caller)
+            if retry_after > 0:
+                return 429, max(1, math.ceil(retry_after))
+
+            if self.waiting[route_class] >= self.max_queued:
+                return 503, max(1, math.ceil(self.queue_timeout))
+            deadline = self.clock() + self.queue_timeout
+            self.waiting[route_class] += 1
+            try:
+                while not self.has_slot(route_class):
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        return 503, max(1, math.ceil(self.queue_timeout))
+                    self.condition.wait(remaining)
+            finally:
+                #Lower priority requests may have been held back by this one.
+                self.waiting[route_class] -= 1
+                self.condition.notify_all()
+            self.in_flight[route_class] += 1
+            return 200, 0
+
+    def release(self, route_class):
+        """ Frees an in-flight slot reserved by admit() and wakes any waiting requests. """
+        with self.condition:
+            self.in_flight[route_class] -= 1
+            self.condition.notify_all()
+
+    def check_rate_limits(self, caller):
+        """
+        Takes a token from the caller's bucket and the global bucket.
+        Returns: 0 if the request is within the rate limits, otherwise the number of seconds until it would be.
+        """
+        if self.caller_rate:
+            bucket = self.caller_buckets.get(caller)
+            if bucket == None:
+                bucket = Token_bucket(self.caller_rate, self.caller_burst, self.clock)
+                self.caller_buckets[caller] = bucket
+                if len(self.caller_buckets) > self.max_callers:
+                    self.caller_buckets.popitem(last=False)
+            else:
+                self.caller_buckets.move_to_end(caller)
+            retry_after = bucket.take()
+            if retry_after > 0:
+                return retry_after
+        if self.global_bucket != None:
+            return self.global_bucket.take()
+        return 0
+
+    def has_slot(self, route_class):
+        """ Checks whether a request of the route class may start now without exceeding a limit or overtaking a higher priority request. """
+        if route_class in self.class_limits and self.in_flight[route_class] >= self.class_limits[route_class]:
+            return False
+        if route_class in self.separate_classes:
+            return True
+        if sum(count for shared_class, count in self.in_flight.items() if shared_class not in self.separate_classes) >= self.max_in_flight:
+            return False
+        #A waiting higher priority request only takes precedence if its own class limit is not what is holding it back.
+        #Separate classes do not compete for the same slots, so never hold back other classes.
+        for higher_class in self.priorities[:self.priorities.index(route_class)]:
+            if higher_class in self.separate_classes:
+                continue
+            if self.waiting[higher_class] > 0 and self.in_flight[higher_class] < self.class_limits.get(higher_class, self.max_in_flight):
+                return False
+        return True
@@ -1,9 +1,14 @@
-from flask import Flask, jsonify, render_template, request
-from wireguard_db import Wireguard_database
+from flask import Flask, Response, g, has_request_context, jsonify, render_template, request
+from wireguard_db import Query_stats, Wireguard_database
+from admission import Admission_controller
+from profiling import Request_profiler
+from workers import Config_cache, Connection_pool, serve_workers
+from coalescer import Write_coalescer
 from waitress import serve
+from werkzeug.middleware.proxy_fix import ProxyFix
 from functools import wraps
 from time import sleep
-import os, logging
+import os, logging, math, tempfile, threading
 
 #Import Database and API server creds from environment variables.
 server = os.environ.get('DB_SERVER')
@@ -16,54 +21,255 @@ api_username = os.environ.get('API_USER')
 with open(os.environ.get('API_PASSWORD_PATH'),'r') as api_password_file:
     api_password = api_password_file.read()
 
-wireguard_state = None
+#Import worker and admission control settings from environment variables. Rate limits are disabled unless set.
+def env_number(name, default=None):
+    value = os.environ.get(name)
+    return float(value) if value else default
 
-while wireguard_state == None:
+n_workers = int(env_number('WORKERS', 1))
+db_connect_timeout = int(env_number('DB_CONNECT_TIMEOUT', 5))
+
+#Provisioning writes from concurrent requests can share a single commit when COALESCE_WRITES is set, at the cost of waiting up to COALESCE_WINDOW seconds for a batch to fill.
+#A request waiting for its batch never borrows a database connection, as its write is run on the writer's own connection, so batched writes have their own in-flight limit, by default enough for one batch to fill while another commits.
+coalesce_writes = bool(os.environ.get('COALESCE_WRITES'))
+coalesce_batch_size = int(env_number('COALESCE_BATCH_SIZE', 64))
+coalesce_limit = int(env_number('COALESCE_LIMIT', 2 * coalesce_batch_size)) if coalesce_writes else 0
+write_class = "batched_writes" if coalesce_writes else "provisioning"
+
+#Every request in flight or queued holds a server thread, so there are enough threads for every batched write on top of the other requests.
+#Threads hold no database connection of their own, so the thread count does not affect the connection budget below.
+server_threads = int(env_number('SERVER_THREADS', 16 + coalesce_limit))
+trusted_proxies = int(env_number('TRUSTED_PROXIES', 1))
+
+#Requests are spread across the worker processes, so each enforces its share of the rate limits.
+def per_worker(rate):
+    return rate / n_workers if rate else rate
+
+max_in_flight = int(env_number('MAX_IN_FLIGHT', 4))
+
+admission = Admission_controller(
+    priorities=("batched_writes", "provisioning", "reads", "bulk"),
+    class_limits={"batched_writes": coalesce_limit, "provisioning": int(env_number('PROVISIONING_LIMIT', 4)), "reads": int(env_number('READS_LIMIT', 4)), "bulk": int(env_number('BULK_LIMIT', 1))},
+    max_in_flight=max_in_flight,
+    separate_classes=("batched_writes",),
+    queue_timeout=env_number('QUEUE_TIMEOUT', 0.5),
+    global_rate=per_worker(env_number('RATE_LIMIT_GLOBAL')),
+    global_burst=per_worker(env_number('RATE_LIMIT_GLOBAL_BURST')),
+    caller_rate=per_worker(env_number('RATE_LIMIT_CALLER')),
+    caller_burst=per_worker(env_number('RATE_LIMIT_CALLER_BURST')))
+
+#Retries until the database is reachable, or raises an exception after the first attempt if retry is False.
+def connect_database(prepare_database=True, retry=True):
+    wireguard_state = None
+    while wireguard_state == None:
+        try:
+            wireguard_state = Wireguard_database(db_server=server, db_port=port, db_database=database, db_user=db_user,db_password=db_password, prepare_database=prepare_database, connect_timeout=db_connect_timeout)
+        except (Exception) as error:
+            logging.error("An error occured while connecting to the database.")
+            if not retry:
+                raise
+        if wireguard_state == None:
+            sleep(5)
+    return wireguard_state
+
+#Requests borrow a connection from the pool the first time they use the database, and return it when they finish; the database is prepared once at startup.
+#Only admitted requests use the database, and at most MAX_IN_FLIGHT of them share the pool, so by default the pool never runs dry.
+#Requests fail with a 500 rather than wait while the database is unreachable, and a lost connection is replaced on the next request.
+db_pool_size = int(env_number('DB_POOL_SIZE', max_in_flight))
+
+def track_request_queries(connection):
+    if has_request_context() and 'query_stats' in g:
+        connection.start_query_tracking(g.query_stats)
+
+wireguard_state = Connection_pool(lambda: connect_database(prepare_database=False, retry=False), size=db_pool_size, timeout=env_number('DB_POOL_TIMEOUT', 5), on_checkout=track_request_queries)
+
+#Batched writes are run by a single writer thread with its own connection.
+coalescer = None
+if coalesce_writes:
+    coalescer = Write_coalescer(lambda: connect_database(prepare_database=False), window=env_number('COALESCE_WINDOW', 0.005), batch_size=coalesce_batch_size, timeout=env_number('COALESCE_TIMEOUT', 10))
+
+#Returns the method's result and None, or None and an error response if a batched write timed out (503) or could not be run (500).
+def apply_write(method_name, *args):
+    if coalescer == None:
+        return getattr(wireguard_state, method_name)(*args), None
     try:
-        wireguard_state = Wireguard_database(db_server=server, db_port=port, db_database=database, db_user=db_user,db_password=db_password)
+        return coalescer.submit(method_name, *args), None
+    except TimeoutError as error:
+        logging.error(f"Batched write {method_name} timed out: %s", error)
+        return None, ("", 503, {'Retry-After': str(max(1, math.ceil(coalescer.timeout)))})
     except (Exception) as error:
-        logging.error("An error occured while connecting to the database.")
-    if wireguard_state == None:
-        sleep(5)
+        logging.error(f"Batched write {method_name} failed: %s", error)
+        return None, ("", 500)
+
+#Server configs are cached until the database announces the server changed. Without a listening connection nothing is cached.
+config_cache = Config_cache()
+
+def run_config_listener():
+    while True:
+        listener_state = connect_database(prepare_database=False)
+        try:
+            listener_state.listen_for_config_changes()
+            config_cache.enable()
+            while True:
+                #A server name of None means every server may have changed, which invalidates every cached config.
+                for server_name in listener_state.poll_config_changes(5):
+                    config_cache.invalidate(server_name)
+        except (Exception) as error:
+            logging.error(f"Lost connection listening for config changes: %s", error)
+            config_cache.disable()
+            listener_state.close()
+            sleep(5)
+
+#Periodically removes peers that have outlived their server's peer TTL, using its own database connection.
+reaper_interval = env_number('REAPER_INTERVAL')
+reaper_batch_size = int(env_number('REAPER_BATCH_SIZE', 500))
+
+def run_reaper():
+    while True:
+        reaper_state = connect_database(prepare_database=False)
+        try:
+            while True:
+                sleep(reaper_interval)
+                reclaimed_leases = reaper_state.reap_expired_peers(reaper_batch_size)
+                if reclaimed_leases == None:
+                    raise Exception("reaping expired peers failed")
+                logging.info(f"Reaper reclaimed {reclaimed_leases} leases from expired peers.")
+        except (Exception) as error:
+            logging.error(f"Reaper lost its connection, reconnecting: %s", error)
+            reaper_state.close()
+            sleep(5)
+
+#Background threads are started once per process, after any fork. Only one process needs to run the reaper.
+def start_background_threads(with_reaper):
+    threading.Thread(target=run_config_listener, daemon=True).start()
+    if reaper_interval and with_reaper:
+        threading.Thread(target=run_reaper, daemon=True).start()
+
+def serve_worker(listening_socket, worker_index):
+    start_background_threads(worker_index == 0)
+    serve(app, sockets=[listening_socket], threads=server_threads)
 
 app = Flask(__name__)
+#Only the X-Forwarded-For entries appended by the trusted proxies are used as the caller's address, any others were sent by the caller.
+if trusted_proxies > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=trusted_proxies)
+#Profiling is off until enabled through the admin API, at which point the profiler is swapped in front of the application.
+profiler = Request_profiler(app.wsgi_app)
+
+#Requests are admitted before anything else is done for them, so a rejected request never touches the database.
+#This hook must stay the first registered, as Flask runs before_request hooks in order and skips the rest once one returns a response.
+@app.before_request
+def admit_request():
+    route_class = getattr(app.view_functions.get(request.endpoint), "route_class", None)
+    if route_class == None:
+        return None
+    caller = request.authorization.username if valid_credentials(request.authorization) else request.remote_addr
+    response_code, retry_after = admission.admit(caller, route_class)
+    if response_code != 200:
+        return "", response_code, {'Retry-After': str(retry_after)}
+    g.route_class = route_class
+
+#Count the database work done by each request and report it in the response headers.
+#Counting starts when the request borrows a connection, so requests that never use the database never borrow one.
+@app.before_request
+def start_query_tracking():
+    g.query_stats = Query_stats()
+
+@app.after_request
+def report_query_stats(response):
+    if 'query_stats' in g:
+        stats = g.query_stats
+        response.headers['X-DB-Queries'] = str(stats.queries)
+        response.headers['X-DB-Commits'] = str(stats.commits)
+        response.headers['X-DB-Rows'] = str(stats.rows)
+        response.headers['X-DB-Time-Ms'] = f"{stats.seconds * 1000:.2f}"
+        logging.debug(f"{request.method} {request.path}: {stats.queries} queries, {stats.commits} commits, {stats.rows} rows, {stats.seconds * 1000:.2f}ms on the database.")
+    return response
+
+#Reads never commit, so each request's transaction is ended here; an idle transaction would hold locks that block truncating or altering tables.
+#The request's connection is then returned to the pool.
+@app.teardown_request
+def end_request(exception):
+    stats = g.pop('query_stats', None)
+    if wireguard_state.current() != None:
+        try:
+            if stats != None:
+                wireguard_state.stop_query_tracking(stats)
+            wireguard_state.end_transaction()
+            wireguard_state.release()
+        except (Exception) as error:
+            logging.error(f"Lost connection to the database, it will be replaced: %s", error)
+            wireguard_state.discard()
+    if 'route_class' in g:
+        admission.release(g.pop('route_class'))
 
 #VERY basic implementation of http-basic authentication.
+def valid_credentials(auth):
+    return auth != None and auth.username == api_username and auth.password == api_password
+
 def auth_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        auth = request.authorization
-        if auth and auth.username == api_username and auth.password == api_password:
+        if valid_credentials(request.authorization):
             return f(*args, **kwargs)
         return "", 401, {'WWW-Authenticate' : 'Basic realm="Login Required"'}
     return decorated
 
+#Profiling state lives in each worker process and a request reaches whichever worker accepts it, so profiling is only available with a single worker.
+def single_worker_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if n_workers > 1:
+            logging.error("Profiling is unavailable when running more than one worker.")
+            return "", 409
+        return f(*args, **kwargs)
+    return decorated
+
+#Assigns a route to a class for admission control; requests are rejected with a 429/503 and a Retry-After header by admit_request() once the caller, or the route class, is over its limits.
+#Callers are identified by their username once their password has been checked, otherwise by their address.
+def admission_required(route_class):
+    def decorator(f):
+        f.route_class = route_class
+        return f
+    return decorator
+
 
 @app.route('/api/v1/client/list_all', methods=["GET"])
+@admission_required("bulk")
 @auth_required
 def return_client_list():
     return jsonify(wireguard_state.list_clients())
 
 @app.route('/api/v1/server/list_all', methods=["GET"])
+@admission_required("bulk")
 @auth_required
 def return_servers_list():
     return jsonify(wireguard_state.list_servers())
 
 #Return all non-sensitive information required to configure a specified wireguard server.
 @app.route('/api/v1/server/config/', methods=["GET"])
+@admission_required("reads")
 @auth_required
 def return_server_conf():
     content = request.json
+    cached = config_cache.get(content['server_name'])
+    if cached != None:
+        revision, response = cached
+        return response, 200, {'X-Config-Revision': str(revision)}
+    generation = config_cache.generation()
+    revision = wireguard_state.get_server_config_revision(content['server_name'])
     response = wireguard_state.get_server_config(content['server_name'])
     if response == None:
         return "", 404
     elif response == {}:
         return "", 500
     else:
-        return response, 200
+        config_cache.put(content['server_name'], (revision, response), generation)
+        return response, 200, {'X-Config-Revision': str(revision)}
 
 #Return all non-sensitive information required to configure a specific client-server peering.
 @app.route('/api/v1/client/config/', methods=["GET"])
+@admission_required("reads")
 def get_client_conf():
     content = request.json
     try:
@@ -77,14 +283,16 @@ def get_client_conf():
 
 #Create a new wireguard server.
 @app.route('/api/v1/server/add/', methods=['POST'])
+@admission_required("provisioning")
 @auth_required
 def create_server():
     content = request.json
-    response_code = wireguard_state.create_server(content['server_name'], content['network_address'], content['network_mask'], content['public_key'], content['endpoint_address'], content['endpoint_port'], content['n_reserved_ips'], content['allowed_ips'])
+    response_code = wireguard_state.create_server(content['server_name'], content['network_address'], content['network_mask'], content['public_key'], content['endpoint_address'], content['endpoint_port'], content['n_reserved_ips'], content['allowed_ips'], content.get('peer_ttl'))
     return "", response_code
 
 #Create a new wireguard server.
 @app.route('/api/v1/server/wireguard_ip/', methods=['GET'])
+@admission_required("reads")
 @auth_required
 def get_server_wireguard_ip():
     content = request.json
@@ -96,6 +304,7 @@ def get_server_wireguard_ip():
 
 #Check if a wireguard server exists.
 @app.route('/api/v1/server/exists/', methods=['GET'])
+@admission_required("reads")
 @auth_required
 def get_server_existance():
     content = request.json
@@ -105,17 +314,24 @@ def get_server_existance():
     else:
         return "", 404
 
-#Create a new client-server peering.
+#Create a client-server peering, or update the public key of an existing one while keeping its lease.
 @app.route('/api/v1/client/add/', methods=['POST'])
+@admission_required(write_class)
 @auth_required
 def create_client():
     content = request.json
-    response_code = wireguard_state.create_client(content['client_name'], content['server_name'], content['public_key'])
-    return "", response_code
+    result, error_response = apply_write("upsert_client", content['client_name'], content['server_name'], content['public_key'])
+    if error_response != None:
+        return error_response
+    response_code, lease = result
+    if lease == None:
+        return "", response_code
+    return {"lease": lease}, response_code
 
 
 #Remove all instances of a client with a specified host name.
 @app.route('/api/v1/client/delete/', methods=['POST'])
+@admission_required("provisioning")
 @auth_required
 def delete_client():
     content = request.json
@@ -123,6 +339,7 @@ def delete_client():
 
 #Removes a server and any row in the database referencing it.
 @app.route('/api/v1/server/delete/', methods=['POST'])
+@admission_required("provisioning")
 @auth_required
 def delete_server():
     content = request.json
@@ -130,11 +347,167 @@ def delete_server():
 
 #Removes the peering instance of a specified client from a specified server.
 @app.route('/api/v1/server/remove_peer/', methods=['POST'])
+@admission_required(write_class)
 @auth_required
 def remove_peer():
     content = request.json
-    return "", wireguard_state.delete_client_peering(content['client_name'], content['server_name'])
+    response_code, error_response = apply_write("delete_client_peering", content['client_name'], content['server_name'])
+    if error_response != None:
+        return error_response
+    return "", response_code
+
+#Stream a consistent snapshot of all servers, subnets, clients and leases.
+@app.route('/api/v1/snapshot/export/', methods=['GET'])
+@admission_required("bulk")
+@auth_required
+def export_snapshot():
+    #Spool the snapshot to disk once it outgrows memory so large exports are streamed rather than held in memory.
+    snapshot_file = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    response_code = wireguard_state.export_snapshot(snapshot_file)
+    if response_code != 200:
+        snapshot_file.close()
+        return "", response_code
+    snapshot_file.seek(0)
+
+    def generate():
+        with snapshot_file:
+            for chunk in iter(lambda: snapshot_file.read(64 * 1024), b""):
+                yield chunk
+    return Response(generate(), mimetype="text/plain")
+
+#Replace all servers, subnets, clients and leases with the snapshot in the request body.
+@app.route('/api/v1/snapshot/import/', methods=['POST'])
+@admission_required("bulk")
+@auth_required
+def import_snapshot():
+    return "", wireguard_state.import_snapshot(request.stream)
+
+#Find client-server peerings by name prefix, server, public key or lease address.
+@app.route('/api/v1/client/search/', methods=['GET'])
+@admission_required("reads")
+@auth_required
+def search_clients():
+    content = request.json
+    response = wireguard_state.search_clients(content.get('client_name_prefix'), content.get('server_name'), content.get('public_key'), content.get('address'), content.get('limit', 100))
+    if response == None:
+        return "", 400
+    elif response == {}:
+        return "", 500
+    else:
+        return response, 200
+
+#Return the used, free and reserved addresses of a specified server's subnet, or of every server's subnet.
+@app.route('/api/v1/server/capacity/', methods=['GET'])
+@admission_required("reads")
+@auth_required
+def get_capacity():
+    content = request.get_json(silent=True) or {}
+    response = wireguard_state.get_capacity(content.get('server_name'))
+    if response == None:
+        return "", 404
+    elif response == False:
+        return "", 500
+    else:
+        return response, 200
+
+#Label values are quoted, so backslashes, quotes and newlines within them must be escaped.
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+#Export subnet capacity in the Prometheus text format.
+@app.route('/api/v1/metrics', methods=['GET'])
+@admission_required("reads")
+@auth_required
+def get_metrics():
+    capacity = wireguard_state.get_capacity()
+    if capacity == False:
+        return "", 500
+    lines = []
+    for metric, field, description in (
+            ("wireguard_subnet_used_ips", "used", "Addresses leased to clients."),
+            ("wireguard_subnet_free_ips", "free", "Addresses available to lease."),
+            ("wireguard_subnet_reserved_ips", "reserved", "Addresses that are never leased."),
+            ("wireguard_subnet_high_water_ips", "high_water", "The most addresses ever leased at once.")):
+        lines += [f"# HELP {metric} {description}", f"# TYPE {metric} gauge"]
+        lines += [f"{metric}{{server=\"{escape_label(server_name)}\",subnet=\"{escape_label(subnet['subnet'])}\"}} {subnet[field]}" for server_name, subnet in capacity.items()]
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+#Set how long the peers of a server may go unseen before they are removed.
+@app.route('/api/v1/server/peer_ttl/', methods=['POST'])
+@admission_required("provisioning")
+@auth_required
+def set_peer_ttl():
+    content = request.json
+    return "", wireguard_state.set_peer_ttl(content['server_name'], content['peer_ttl'])
+
+#Record that a client-server peering is still in use.
+@app.route('/api/v1/client/heartbeat/', methods=['POST'])
+@admission_required("reads")
+def client_heartbeat():
+    content = request.json
+    return "", wireguard_state.touch_client(content['client_name'], content['server_name'])
+
+#Remove all expired peers now, rather than waiting for the reaper.
+@app.route('/api/v1/admin/reap/', methods=['POST'])
+@admission_required("bulk")
+@auth_required
+def reap_expired_peers():
+    reclaimed_leases = wireguard_state.reap_expired_peers(reaper_batch_size)
+    if reclaimed_leases == None:
+        return "", 500
+    return {"reclaimed_leases": reclaimed_leases}, 200
+
+#Enable, reconfigure or disable request profiling. Reconfiguring discards any results collected so far.
+@app.route('/api/v1/admin/profiling/', methods=['POST'])
+@admission_required("bulk")
+@auth_required
+@single_worker_required
+def configure_profiling():
+    content = request.json
+    if not content.get('enabled', False):
+        app.wsgi_app = profiler.app
+        profiler.stop()
+        return "", 200
+    try:
+        profiler.configure(content.get('mode', 'cprofile'), content.get('sample_rates'), content.get('default_rate', 0.0))
+    except (ValueError, TypeError) as error:
+        logging.error(f"Could not configure profiling: %s", error)
+        return "", 400
+    if profiler.mode == "wall":
+        profiler.start()
+    else:
+        profiler.stop()
+    app.wsgi_app = profiler
+    return "", 200
+
+#Download the cProfile results, for a single path if given, in pstats format.
+@app.route('/api/v1/admin/profiling/pstats/', methods=['GET'])
+@admission_required("bulk")
+@auth_required
+@single_worker_required
+def download_pstats():
+    stats = profiler.dump_pstats(request.args.get('path'))
+    if stats == None:
+        return "", 404
+    return Response(stats, mimetype="application/octet-stream", headers={'Content-Disposition': 'attachment; filename=wireguard_api.pstats'})
+
+#Download the wall-clock stack samples in the folded format used by flamegraph tools.
+@app.route('/api/v1/admin/profiling/flamegraph/', methods=['GET'])
+@admission_required("bulk")
+@auth_required
+@single_worker_required
+def download_flamegraph():
+    return Response(profiler.dump_folded(), mimetype="text/plain")
 
 if __name__ == "__main__":
-    serve(app, host="0.0.0.0", port=5000)
+    #Format or migrate the database once, before any worker connects.
+    connect_database().close()
+    #Besides its pool, each worker holds a connection for the config listener and one for the write batcher, and the first worker one for the reaper.
+    db_connection_budget = n_workers * (db_pool_size + 1 + (1 if coalesce_writes else 0)) + (1 if reaper_interval else 0)
+    logging.info(f"The API will use at most {db_connection_budget} database connections, which must be within the database's max_connections.")
+    if n_workers > 1:
+        serve_workers(serve_worker, "0.0.0.0", 5000, n_workers)
+    else:
+        start_background_threads(True)
+        serve(app, host="0.0.0.0", port=5000, threads=server_threads)
 #    app.run(debug=1)
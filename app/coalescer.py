@@ -0,0 +1,140 @@
+import logging, queue, threading, time
+
+class Pending_write():
+    """
+    A write operation waiting to be run by a Write_coalescer.
+
+    Attributes
+    ----------
+    method_name : str
+        The Wireguard_database method to call.
+    args : tuple
+        The arguments to call the method with.
+    result
+        The value returned by the method, once it has run.
+    error : Exception
+        The exception raised while running the method, if any.
+    done : threading.Event
+        Set once the operation has run.
+    abandoned : bool
+        Whether the caller stopped waiting before the operation was run, in which case it is skipped.
+    """
+    def __init__(self, method_name, args):
+        self.method_name = method_name
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self.abandoned = False
+
+class Write_coalescer():
+    """
+    Collects write operations submitted by concurrent requests and runs them in batches, each in a single transaction, so the cost of a commit is shared by the whole batch.
+    A batch is run once batch_size operations are waiting, or window seconds after its first operation arrived.
+    If a batch cannot be committed, its operations are retried one at a time so each caller still receives its own result.
+
+    Attributes
+    ----------
+    connect : function
+        Creates the Wireguard_database connection batches are run on.
+    window : float
+        The longest, in seconds, an operation waits for others to join its batch.
+    batch_size : int
+        The most operations run in a single batch.
+    timeout : float
+        The longest, in seconds, a caller waits for its operation to run.
+
+    Methods
+    -------
+    submit()
+        Runs a write operation as part of a batch and returns its result.
+    """
+    def __init__(self, connect, window=0.005, batch_size=64, timeout=10):
+        """
+        Parameters
+        ----------
+        connect : function
+            Creates the Wireguard_database connection batches are run on.
+        window : float
+            The longest an operation waits for others to join its batch (default is 0.005)
+        batch_size : int
+            The most operations run in a single batch (default is 64)
+        timeout : float
+            The longest a caller waits for its operation to run (default is 10)
+        """
+        self.connect = connect
+        self.window = window
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        self.writer = None
+
+    def submit(self, method_name, *args):
+        """
+        Queues a call of a Wireguard_database method, such as submit("upsert_client", client_name, server_name, public_key), and waits for it to run.
+        Returns: The value returned by the method.
+        Raises: TimeoutError if the operation has not run within timeout seconds. An operation already being run when the caller gives up may still be applied.
+        """
+        with self.lock:
+            #The writer thread is started on first use so it is never created before a worker process forks.
+            if self.writer == None:
+                self.writer = threading.Thread(target=self.run_writer, daemon=True)
+                self.writer.start()
+        operation = Pending_write(method_name, args)
+        self.pending.put(operation)
+        if not operation.done.wait(self.timeout):
+            operation.abandoned = True
+            raise TimeoutError(f"{method_name} was not run within {self.timeout} seconds")
+        if operation.error != None:
+            raise operation.error
+        return operation.result
+
+    def collect_batch(self):
+        """ Waits for an operation, then for up to window seconds or batch_size operations. Returns: The operations collected. """
+        batch = [self.pending.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run_writer(self):
+        wireguard_state = self.connect()
+        while True:
+            batch = [operation for operation in self.collect_batch() if not operation.abandoned]
+            if len(batch) == 0:
+                continue
+            failed = False
+            try:
+                results = wireguard_state.run_batch([(operation.method_name, operation.args) for operation in batch])
+                if results == None:
+                    logging.error(f"Batch of {len(batch)} writes failed, retrying them individually.")
+                    results = [wireguard_state.run_batch([(operation.method_name, operation.args)]) for operation in batch]
+                    #If not even a single write can be committed the connection is assumed lost.
+                    failed = all(result == None for result in results)
+                    results = [result[0] if result != None else Exception("Could not commit write.") for result in results]
+                for operation, result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        operation.error = result
+                    else:
+                        operation.result = result
+            except Exception as error:
+                logging.error(f"Could not run batch of {len(batch)} writes: %s", error)
+                failed = True
+                for operation in batch:
+                    operation.error = error
+            finally:
+                for operation in batch:
+                    operation.done.set()
+            if failed:
+                try:
+                    wireguard_state.close()
+                except Exception:
+                    pass
+                wireguard_state = self.connect()
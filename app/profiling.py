@@ -0,0 +1,164 @@
+import cProfile, marshal, pstats, random, sys, threading
+from collections import Counter
+
+class Request_profiler():
+    """
+    WSGI middleware that profiles a sample of requests and aggregates the results per path.
+    The profiler only wraps the application while profiling is enabled, so it costs nothing while disabled.
+
+    Attributes
+    ----------
+    app : function
+        The WSGI application being profiled.
+    mode : str
+        "cprofile" to record deterministic profiles, or "wall" to record wall-clock stack samples.
+    sample_rates : dict
+        The fraction of requests to profile for each path.
+    default_rate : float
+        The fraction of requests to profile for paths not in sample_rates.
+    interval : float
+        The seconds between stack samples in wall mode.
+
+    Methods
+    -------
+    configure()
+        Sets the mode and sample rates, discarding any collected results.
+    start()
+        Starts the wall-clock stack sampler.
+    stop()
+        Stops the wall-clock stack sampler.
+    dump_pstats()
+        Returns the aggregated cProfile results in the pstats file format.
+    dump_folded()
+        Returns the aggregated stack samples in the folded format used by flamegraph tools.
+    """
+    modes = ("cprofile", "wall")
+
+    def __init__(self, app, mode="cprofile", sample_rates=None, default_rate=0.0, interval=0.005):
+        """
+        Parameters
+        ----------
+        app : function
+            The WSGI application to profile.
+        mode : str
+            "cprofile" or "wall" (default is cprofile)
+        sample_rates : dict
+            The fraction of requests to profile for each path (default is None)
+        default_rate : float
+            The fraction of requests to profile for any other path (default is 0)
+        interval : float
+            The seconds between stack samples in wall mode (default is 0.005)
+        """
+        self.app = app
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.sampler = None
+        self.stopped = threading.Event()
+        self.configure(mode, sample_rates, default_rate)
+
+    def configure(self, mode, sample_rates=None, default_rate=0.0):
+        """
+        Sets what is profiled, and how, discarding any results collected so far.
+        Raises: ValueError if the mode or a sample rate is invalid.
+        """
+        if mode not in self.modes:
+            raise ValueError(f"unknown profiling mode \"{mode}\"")
+        sample_rates = dict(sample_rates or {})
+        for rate in list(sample_rates.values()) + [default_rate]:
+            if not 0 <= rate <= 1:
+                raise ValueError(f"sample rate {rate} not between 0 and 1")
+        with self.lock:
+            self.mode = mode
+            self.sample_rates = sample_rates
+            self.default_rate = default_rate
+            self.stats = {}
+            self.samples = Counter()
+            self.active_threads = {}
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        rate = self.sample_rates.get(path, self.default_rate)
+        if rate <= 0 or random.random() >= rate:
+            return self.app(environ, start_response)
+        if self.mode == "wall":
+            return self.sample_request(path, environ, start_response)
+        return self.profile_request(path, environ, start_response)
+
+    def profile_request(self, path, environ, start_response):
+        """ Serves a request under cProfile and adds the profile to the path's results. """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            #Another profiler is already running in this interpreter, serve the request unprofiled.
+            return self.app(environ, start_response)
+        try:
+            return self.app(environ, start_response)
+        finally:
+            profile.disable()
+            with self.lock:
+                if path in self.stats:
+                    self.stats[path].add(profile)
+                else:
+                    self.stats[path] = pstats.Stats(profile)
+
+    def sample_request(self, path, environ, start_response):
+        """ Serves a request while the sampler records the stack of the serving thread. """
+        thread_id = threading.get_ident()
+        with self.lock:
+            self.active_threads[thread_id] = path
+        try:
+            return self.app(environ, start_response)
+        finally:
+            with self.lock:
+                self.active_threads.pop(thread_id, None)
+
+    def start(self):
+        """ Starts the thread that samples the stacks of requests being profiled in wall mode. """
+        if self.sampler != None and self.sampler.is_alive():
+            return
+        self.stopped.clear()
+        self.sampler = threading.Thread(target=self.run_sampler, daemon=True)
+        self.sampler.start()
+
+    def stop(self):
+        """ Stops the sampler thread, keeping any samples already collected. """
+        self.stopped.set()
+        if self.sampler != None:
+            self.sampler.join()
+            self.sampler = None
+
+    def run_sampler(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                if len(self.active_threads) == 0:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, path in self.active_threads.items():
+                    frame = frames.get(thread_id)
+                    stack = []
+                    while frame != None:
+                        stack.append(f"{frame.f_code.co_filename}:{frame.f_code.co_name}")
+                        frame = frame.f_back
+                    self.samples[";".join([path] + stack[::-1])] += 1
+
+    def dump_pstats(self, path=None):
+        """
+        Returns the cProfile results for a path, or for all paths if none is given, in the format written by pstats.Stats.dump_stats().
+        Returns None if nothing has been profiled.
+        """
+        with self.lock:
+            if path != None:
+                stats = [self.stats[path]] if path in self.stats else []
+            else:
+                stats = list(self.stats.values())
+            if len(stats) == 0:
+                return None
+            combined = pstats.Stats()
+            combined.add(*stats)
+            return marshal.dumps(combined.stats)
+
+    def dump_folded(self):
+        """ Returns the wall-clock stack samples as lines of "path;frame;frame count", rooted at the request path. """
+        with self.lock:
+            return "".join(f"{stack} {count}\n" for stack, count in sorted(self.samples.items()))
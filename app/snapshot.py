@@ -0,0 +1,31 @@
+from wireguard_db import Wireguard_database
+import argparse, os, sys
+
+#Exports or imports a snapshot of the database directly, using the same environment variables as app.py. The database must already have been prepared by the API.
+#e.g. "python snapshot.py export backup.snap" or "python snapshot.py import backup.snap"
+def main():
+    parser = argparse.ArgumentParser(description="Export or import a snapshot of all wireguard servers, subnets, clients and leases.")
+    parser.add_argument("action", choices=["export", "import"])
+    parser.add_argument("file", nargs="?", default="-", help="Snapshot file to write to or read from (default is stdout/stdin).")
+    args = parser.parse_args()
+
+    with open(os.environ.get('DB_PASSWORD_PATH'),'r') as db_password_file:
+        db_password = db_password_file.read()
+    wireguard_state = Wireguard_database(db_server=os.environ.get('DB_SERVER'), db_port=os.environ.get('DB_PORT'), db_database=os.environ.get('DB_NAME'), db_user=os.environ.get('DB_USER'), db_password=db_password, prepare_database=False)
+
+    if args.action == "export":
+        if args.file == "-":
+            response_code = wireguard_state.export_snapshot(sys.stdout.buffer)
+        else:
+            with open(args.file, 'wb') as snapshot_file:
+                response_code = wireguard_state.export_snapshot(snapshot_file)
+    else:
+        if args.file == "-":
+            response_code = wireguard_state.import_snapshot(sys.stdin.buffer)
+        else:
+            with open(args.file, 'rb') as snapshot_file:
+                response_code = wireguard_state.import_snapshot(snapshot_file)
+    return 0 if response_code == 200 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,170 @@
+import argparse, base64, ipaddress, json, logging, os, subprocess, sys, time, urllib.request
+
+def run_command(args):
+    """ Runs a command, raising an exception if it fails. Returns: The command's standard output. """
+    return subprocess.run(args, check=True, capture_output=True, text=True).stdout
+
+class Wireguard_agent():
+    """
+    Keeps the peers of a local wireguard interface in line with the peer list the API holds for a server.
+    Only the peers that differ are changed, applied with as few "wg set" calls as fit within max_command_bytes each, so existing peers keep their sessions.
+
+    Attributes
+    ----------
+    api_url : str
+        The base URL of the API, e.g. https://wireguard_api.example.com
+    server_name : str
+        The name of the server, as registered with the API, whose peers are applied.
+    interface : str
+        The wireguard interface to configure.
+    runner : function
+        Runs a command, given as a list of arguments, and returns its standard output.
+    max_command_bytes : int
+        The most bytes of arguments passed to a single wg command, kept well below the operating system's limit.
+
+    Methods
+    -------
+    fetch_peers()
+        Retrieves the peers the API holds for the server.
+    read_interface()
+        Retrieves the peers currently configured on the interface.
+    diff_peers()
+        Finds the peers that must be added, changed or removed.
+    build_commands()
+        Builds the wg commands that apply a set of changes.
+    reconcile()
+        Applies any differences between the API and the interface.
+    """
+    def __init__(self, api_url, server_name, interface, api_user=None, api_password=None, wg_binary="wg", runner=run_command, max_command_bytes=65536):
+        """
+        Parameters
+        ----------
+        api_url : str
+            The base URL of the API.
+        server_name : str
+            The name of the server whose peers are applied.
+        interface : str
+            The wireguard interface to configure.
+        api_user : str
+            The user to authenticate to the API with (default is None)
+        api_password : str
+            The password to authenticate to the API with (default is None)
+        wg_binary : str
+            The wg command to run (default is wg)
+        runner : function
+            Runs a command and returns its standard output (default is run_command)
+        max_command_bytes : int
+            The most bytes of arguments passed to a single wg command (default is 65536)
+        """
+        self.api_url = api_url.rstrip("/")
+        self.server_name = server_name
+        self.interface = interface
+        self.api_user = api_user
+        self.api_password = api_password
+        self.wg_binary = wg_binary
+        self.runner = runner
+        self.max_command_bytes = max_command_bytes
+
+    def fetch_peers(self):
+        """
+        Returns the peers the API holds for the server, as a dict of public key to a set of allowed IPs.
+        """
+        request = urllib.request.Request(f"{self.api_url}/api/v1/server/config/", data=json.dumps({"server_name": self.server_name}).encode(), method="GET")
+        request.add_header("Content-Type", "application/json")
+        if self.api_user != None:
+            credentials = base64.b64encode(f"{self.api_user}:{self.api_password}".encode()).decode()
+            request.add_header("Authorization", f"Basic {credentials}")
+        with urllib.request.urlopen(request) as response:
+            config = json.load(response)
+        return {peer["public_key"]: {str(ipaddress.ip_network(f"{peer['ip_address']}/32"))} for peer in config["peers"]}
+
+    def read_interface(self):
+        """
+        Returns the peers configured on the interface, read from "wg show <interface> dump", as a dict of public key to a set of allowed IPs.
+        """
+        output = self.runner([self.wg_binary, "show", self.interface, "dump"])
+        peers = {}
+        #The first line describes the interface itself, each following line is a peer.
+        for line in output.splitlines()[1:]:
+            fields = line.split("\t")
+            if len(fields) < 4:
+                continue
+            allowed_ips = fields[3]
+            peers[fields[0]] = set() if allowed_ips == "(none)" else {str(ipaddress.ip_network(ip, strict=False)) for ip in allowed_ips.split(",")}
+        return peers
+
+    def diff_peers(self, desired_peers, live_peers):
+        """
+        Compares the peers the API holds with the peers on the interface.
+        Returns: A dict of public key to allowed IPs for peers to add or change, and a sorted list of public keys to remove.
+        """
+        changes = {public_key: allowed_ips for public_key, allowed_ips in desired_peers.items() if live_peers.get(public_key) != allowed_ips}
+        removals = sorted(public_key for public_key in live_peers if public_key not in desired_peers)
+        return changes, removals
+
+    def build_commands(self, changes, removals):
+        """
+        Returns the wg set commands applying all changes and removals, removals first.
+        Peers are split across commands so that no command's arguments exceed max_command_bytes, as a freshly provisioned server may have tens of thousands of peers to add.
+        """
+        peer_arguments = [["peer", public_key, "remove"] for public_key in removals]
+        peer_arguments += [["peer", public_key, "allowed-ips", ",".join(sorted(changes[public_key]))] for public_key in sorted(changes)]
+        prefix = [self.wg_binary, "set", self.interface]
+        commands = []
+        command, command_bytes = None, 0
+        for arguments in peer_arguments:
+            #Each argument is passed with a terminating null byte.
+            arguments_bytes = sum(len(argument.encode()) + 1 for argument in arguments)
+            if command == None or command_bytes + arguments_bytes > self.max_command_bytes:
+                command = list(prefix)
+                command_bytes = sum(len(argument.encode()) + 1 for argument in prefix)
+                commands.append(command)
+            command += arguments
+            command_bytes += arguments_bytes
+        return commands
+
+    def reconcile(self):
+        """
+        Applies any differences between the peers the API holds and the peers on the interface.
+        Returns: The number of peers added, changed or removed.
+        """
+        changes, removals = self.diff_peers(self.fetch_peers(), self.read_interface())
+        if len(changes) + len(removals) == 0:
+            logging.debug(f"Peers of {self.interface} are up to date.")
+            return 0
+        for command in self.build_commands(changes, removals):
+            self.runner(command)
+        logging.info(f"Updated {len(changes)} and removed {len(removals)} peers of {self.interface}.")
+        return len(changes) + len(removals)
+
+#Reconciles the interface on a time interval, e.g. "python wireguard_agent.py https://wireguard_api.example.com wireguard01 wg0"
+def main():
+    parser = argparse.ArgumentParser(description="Keep the peers of a wireguard interface in line with the wireguard API.")
+    parser.add_argument("api_url")
+    parser.add_argument("server_name")
+    parser.add_argument("interface")
+    parser.add_argument("--interval", type=float, default=30, help="Seconds between reconciliations (default is 30).")
+    parser.add_argument("--once", action="store_true", help="Reconcile once and exit.")
+    parser.add_argument("--wg", default="wg", help="The wg command to run (default is wg).")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    api_password = None
+    if os.environ.get('API_PASSWORD_PATH'):
+        with open(os.environ.get('API_PASSWORD_PATH'),'r') as api_password_file:
+            api_password = api_password_file.read()
+    agent = Wireguard_agent(args.api_url, args.server_name, args.interface, os.environ.get('API_USER'), api_password, args.wg)
+
+    while True:
+        try:
+            agent.reconcile()
+        except Exception as error:
+            logging.error(f"Could not reconcile peers of {args.interface}: %s", error)
+            if args.once:
+                return 1
+        if args.once:
+            return 0
+        time.sleep(args.interval)
+
+if __name__ == "__main__":
+    sys.exit(main())
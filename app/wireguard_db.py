@@ -1,4 +1,81 @@
-import psycopg2, ipaddress, re, logging
+import psycopg2, psycopg2.errorcodes, psycopg2.extensions, psycopg2.sql, ipaddress, re, logging, select, threading, time
+from contextlib import contextmanager
+
+class Query_stats():
+    """
+    Counts the database work done while queries are being tracked.
+
+    Attributes
+    ----------
+    queries : int
+        The number of statements sent to the database.
+    commits : int
+        The number of transactions committed.
+    rows : int
+        The number of rows returned or affected by the statements.
+    seconds : float
+        The time spent waiting on the statements and commits.
+    previous : Query_stats
+        The tracking this was nested within, if any.
+    """
+    def __init__(self):
+        self.queries = 0
+        self.commits = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.previous = None
+
+    def add(self, other):
+        """ Adds the counts of another Query_stats to this one. """
+        self.queries += other.queries
+        self.commits += other.commits
+        self.rows += other.rows
+        self.seconds += other.seconds
+
+class Accounting_connection(psycopg2.extensions.connection):
+    """
+    A psycopg2 connection that records commits, and the statements run by its Accounting_cursors, against the Query_stats being tracked by the calling thread.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tracking = threading.local()
+
+    def tracked_stats(self):
+        """ Returns the Query_stats being tracked by the calling thread, or None. """
+        return getattr(self.tracking, "stats", None)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            stats = self.tracked_stats()
+            if stats != None:
+                stats.commits += 1
+                stats.seconds += time.perf_counter() - start
+
+class Accounting_cursor(psycopg2.extensions.cursor):
+    """ A psycopg2 cursor that records every statement it runs against its Accounting_connection. """
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self.record(start)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            self.record(start)
+
+    def record(self, start):
+        stats = self.connection.tracked_stats()
+        if stats != None:
+            stats.queries += 1
+            stats.rows += max(self.rowcount, 0)
+            stats.seconds += time.perf_counter() - start
 
 class Wireguard_database():
     """
@@ -10,6 +87,14 @@ class Wireguard_database():
         The connection to the postgres database.
     db_cursor : psycopg2.extensions.cursor
         psycopg2 used for issuing commands to the database.
+    batching : bool
+        Whether a batch is being run by run_batch(), in which case operations do not commit their own changes.
+    schema_version : int
+        The version of the schema migrate_database() brings a database up to.
+    snapshot_tables : tuple
+        The tables, and their columns, included in a snapshot. Listed in the order they must be restored in.
+    snapshot_sequences : tuple
+        The serial columns whose sequences must be moved forward after a snapshot is restored.
 
     Methods
     -------
@@ -17,6 +102,10 @@ class Wireguard_database():
         Checks for a valid Postgres database that already store context.
     format_database()
         Called to create the tables required when conencting to an empty database.
+    get_schema_version()
+        Retrieves the version of the schema the database was last migrated to.
+    migrate_database()
+        Adds any columns, indexes and triggers missing from a database created by an earlier version.
     create_server()
         Adds a new server instance to the database.
     delete_server()
@@ -25,6 +114,8 @@ class Wireguard_database():
         Adds a subnet to the database referencing a server.
     create_client()
         Ensures a client-server peering exists with the given parameters.
+    upsert_client()
+        Ensures a client-server peering exists with the given parameters, returning its lease.
     delete_client()
         Removes all instances from the database where the client name is referenced.
     delete_client_peering()
@@ -33,6 +124,10 @@ class Wireguard_database():
         Assigns an IP Address to be used by the client when connecting to the server.
     get_next_ip()
         Finds the next IP available for a specific server.
+    count_usable_ips()
+        Counts the addresses in a subnet that can be leased to clients.
+    get_capacity()
+        Retrieves the used, free and reserved addresses of each server's subnet.
     ip_to_int()
         Creates an interger that can be converted back IPv4Address object later.
     list_clients()
@@ -51,8 +146,51 @@ class Wireguard_database():
         Retrieves all non-sensitive details required to configure a client.
     get_server_config()
         Retrieves all non-sensitive details required to configure a server.
+    get_server_config_revision()
+        Retrieves the number of times a server's peer list has changed.
+    search_clients()
+        Finds client-server peerings by name prefix, server, public key or lease address.
+    set_peer_ttl()
+        Sets how long a server's peers may go unseen before they expire.
+    touch_client()
+        Records that a client has been seen.
+    reap_expired_peers()
+        Deletes every peering that has not been seen within its server's peer TTL.
+    commit_changes()
+        Commits the current transaction, unless running a batch.
+    rollback_changes()
+        Rolls back the current transaction, or the current operation of a batch.
+    run_batch()
+        Runs several write operations in a single transaction.
+    end_transaction()
+        Ends the current transaction, releasing its locks.
+    close()
+        Closes the connection to the database.
+    listen_for_config_changes()
+        Subscribes the connection to notifications of changed server configs.
+    poll_config_changes()
+        Waits for notifications of changed server configs.
+    track_queries()
+        Counts the statements, commits, rows and time spent on the database within a block.
+    start_query_tracking()
+        Starts counting the database work done by the calling thread.
+    stop_query_tracking()
+        Stops counting the database work done by the calling thread.
+    export_snapshot()
+        Streams a consistent copy of every table to a file.
+    import_snapshot()
+        Replaces the contents of every table with a snapshot read from a file.
     """
-    def __init__(self, db_server="127.0.0.1", db_port="5432", db_database="postgres", db_user="postgres", db_password="changeme123"):
+    schema_version = 2
+    snapshot_tables = (
+        ("servers", ("serverID", "public_key", "endpoint_address", "endpoint_port", "peer_ttl", "config_revision")),
+        ("subnets", ("subnetID", "serverID", "allowed_ips", "server_ip", "network_address", "network_mask", "n_reserved_ips", "high_water")),
+        ("clients", ("clientID", "client_name", "public_key", "serverID", "last_seen")),
+        ("leases", ("leaseID", "subnetID", "clientID", "ip_address")),
+    )
+    snapshot_sequences = (("subnets", "subnetID"), ("clients", "clientID"), ("leases", "leaseID"))
+
+    def __init__(self, db_server="127.0.0.1", db_port="5432", db_database="postgres", db_user="postgres", db_password="changeme123", prepare_database=True, connect_timeout=None):
         """
         Parameters
         ----------
@@ -66,10 +204,14 @@ class Wireguard_database():
             The user to connect to the database (default is postgres)
         db_password : str
             The password for the user connecting to the database (default is changeme123)
+        prepare_database : bool
+            Whether to format or migrate the database after connecting, which can be skipped once another connection has done so. (default is True)
+        connect_timeout : int
+            The seconds to wait for the database to accept the connection, None to wait indefinitely. (default is None)
         """
         logging.basicConfig(level=logging.DEBUG)
         try:
-            self.db_connection = psycopg2.connect(host = db_server, database = db_database, port = db_port, user = db_user, password = db_password)
+            self.db_connection = psycopg2.connect(host = db_server, database = db_database, port = db_port, user = db_user, password = db_password, connect_timeout = connect_timeout, connection_factory = Accounting_connection, cursor_factory = Accounting_cursor)
             self.cursor = self.db_connection.cursor()
         except (Exception, psycopg2.DatabaseError) as error:
             logging.fatal(f"Unable to connect to database, failed with error: %s", error)
@@ -79,7 +221,10 @@ class Wireguard_database():
 
         if self.db_connection == None:
             raise Exception("Unreachable")
+        self.batching = False
 
+        if not prepare_database:
+            return
         if not self.validate_database():
             if not self.format_database():
                 logging.fatal("Failed to format database.")
@@ -87,6 +232,10 @@ class Wireguard_database():
         else:
             logging.debug("Found tables within database.")
 
+        if not self.migrate_database():
+            logging.fatal("Failed to migrate database.")
+            raise Exception("Corrupt")
+
     def validate_database(self):
         """ Performs a very basic check on the data base of existing content. 
         If any tables are found, database is assumed valid.
@@ -159,14 +308,146 @@ class Wireguard_database():
             logging.debug("Successfully formatted database.")
             return True
 
-    def create_server(self, server_name, network_address, network_mask, public_key, endpoint_address, endpoint_port, n_reserved_ips, allowed_ips):
+    def get_schema_version(self):
+        """ Returns: The schema version the database was last migrated to, or 0 if it has never been migrated. """
+        self.cursor.execute("SELECT to_regclass('schema_version') IS NOT NULL;")
+        if not self.cursor.fetchone()[0]:
+            return 0
+        self.cursor.execute("SELECT MAX(version) FROM schema_version;")
+        return self.cursor.fetchone()[0] or 0
+
+    def migrate_database(self):
+        """
+        Brings the schema of an existing database up to date, unless it was already migrated to schema_version.
+        Altering a table waits for every open transaction using it, so the schema version is checked first and nothing is locked when the database is current.
+        The migration holds an advisory lock so that several API processes starting at once do not race each other, and gives up after lock_timeout rather than queueing every other query behind it.
+        """
+        try:
+            if self.get_schema_version() >= self.schema_version:
+                self.db_connection.commit()
+                logging.debug("Database schema is up to date.")
+                return True
+            self.cursor.execute("SELECT pg_advisory_xact_lock(5128);")
+            #Another process may have migrated the database while this one waited for the lock.
+            if self.get_schema_version() >= self.schema_version:
+                self.db_connection.commit()
+                return True
+            self.cursor.execute("SET LOCAL lock_timeout = '5s';")
+            self.cursor.execute("SELECT COUNT(*) FROM information_schema.columns WHERE table_name = 'subnets' AND column_name = 'n_leases';")
+            lease_counts_exist = self.cursor.fetchone()[0] > 0
+            self.cursor.execute("""
+            ALTER TABLE servers ADD COLUMN IF NOT EXISTS peer_ttl INT;
+            ALTER TABLE servers ADD COLUMN IF NOT EXISTS config_revision BIGINT NOT NULL DEFAULT 0;
+            ALTER TABLE clients ADD COLUMN IF NOT EXISTS last_seen TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now();
+            CREATE INDEX IF NOT EXISTS clients_serverID_last_seen_idx ON clients (serverID, last_seen);
+            CREATE INDEX IF NOT EXISTS clients_client_name_prefix_idx ON clients (client_name varchar_pattern_ops);
+            CREATE INDEX IF NOT EXISTS leases_ip_address_inet_idx ON leases USING gist ((ip_address::inet) inet_ops);
+            ALTER TABLE subnets ADD COLUMN IF NOT EXISTS n_leases INT NOT NULL DEFAULT 0;
+            ALTER TABLE subnets ADD COLUMN IF NOT EXISTS high_water INT NOT NULL DEFAULT 0;
+            """)
+            #Duplicate peerings, left by re-enrolments before the unique index existed, are removed keeping the latest, which holds the current public key.
+            self.cursor.execute("""
+            WITH removed AS (
+                DELETE FROM clients USING clients AS kept
+                WHERE clients.serverID = kept.serverID AND clients.client_name = kept.client_name AND clients.clientID < kept.clientID
+                RETURNING clients.clientID, clients.client_name, clients.serverID, clients.public_key)
+            SELECT removed.client_name, removed.serverID, removed.clientID, removed.public_key, leases.ip_address
+            FROM removed LEFT JOIN leases ON leases.clientID = removed.clientID;
+            """)
+            for client_name, server_name, clientID, public_key, ip_address in self.cursor.fetchall():
+                logging.warning(f"Removed duplicate peering {client_name}-{server_name} (clientID {clientID}, public key {public_key}, lease {ip_address}), keeping its latest enrolment.")
+            self.cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS clients_serverID_client_name_idx ON clients (serverID, client_name);")
+            #Lease counts are maintained by the triggers below from here on, so existing leases only need counting once.
+            if not lease_counts_exist:
+                self.cursor.execute("""
+                UPDATE subnets SET n_leases = counted.n_leases, high_water = counted.n_leases
+                FROM (SELECT subnetID, COUNT(*) AS n_leases FROM leases GROUP BY subnetID) AS counted
+                WHERE subnets.subnetID = counted.subnetID;
+                """)
+            #Any change to a server's leases, or to a peer's public key, changes its peer list, so the server's config revision is bumped.
+            #The same statement level triggers keep each subnet's lease count and high-water mark in step with its leases.
+            #Every change to a server, including its config revision, is announced on the config_changed channel so API processes can drop cached configs.
+            self.cursor.execute("""
+            CREATE OR REPLACE FUNCTION leases_inserted() RETURNS trigger AS $$
+            BEGIN
+                UPDATE subnets SET n_leases = subnets.n_leases + inserted.n_leases, high_water = GREATEST(subnets.high_water, subnets.n_leases + inserted.n_leases)
+                FROM (SELECT subnetID, COUNT(*) AS n_leases FROM new_leases GROUP BY subnetID) AS inserted
+                WHERE subnets.subnetID = inserted.subnetID;
+                UPDATE servers SET config_revision = config_revision + 1
+                WHERE serverID IN (SELECT subnets.serverID FROM subnets WHERE subnets.subnetID IN (SELECT subnetID FROM new_leases));
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+            CREATE OR REPLACE FUNCTION leases_deleted() RETURNS trigger AS $$
+            BEGIN
+                UPDATE subnets SET n_leases = subnets.n_leases - deleted.n_leases
+                FROM (SELECT subnetID, COUNT(*) AS n_leases FROM old_leases GROUP BY subnetID) AS deleted
+                WHERE subnets.subnetID = deleted.subnetID;
+                UPDATE servers SET config_revision = config_revision + 1
+                WHERE serverID IN (SELECT subnets.serverID FROM subnets WHERE subnets.subnetID IN (SELECT subnetID FROM old_leases));
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+            CREATE OR REPLACE FUNCTION clients_key_changed() RETURNS trigger AS $$
+            BEGIN
+                UPDATE servers SET config_revision = config_revision + 1 WHERE serverID = NEW.serverID;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+            CREATE OR REPLACE FUNCTION servers_changed() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    PERFORM pg_notify('config_changed', OLD.serverID);
+                ELSE
+                    PERFORM pg_notify('config_changed', NEW.serverID);
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+            DO $$
+            BEGIN
+                IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'clients_key_changed') THEN
+                    CREATE TRIGGER clients_key_changed AFTER UPDATE OF public_key ON clients
+                    FOR EACH ROW WHEN (OLD.public_key IS DISTINCT FROM NEW.public_key) EXECUTE PROCEDURE clients_key_changed();
+                END IF;
+                IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'servers_changed') THEN
+                    CREATE TRIGGER servers_changed AFTER UPDATE OR DELETE ON servers
+                    FOR EACH ROW EXECUTE PROCEDURE servers_changed();
+                END IF;
+                IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'leases_inserted') THEN
+                    CREATE TRIGGER leases_inserted AFTER INSERT ON leases REFERENCING NEW TABLE AS new_leases
+                    FOR EACH STATEMENT EXECUTE PROCEDURE leases_inserted();
+                END IF;
+                IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'leases_deleted') THEN
+                    CREATE TRIGGER leases_deleted AFTER DELETE ON leases REFERENCING OLD TABLE AS old_leases
+                    FOR EACH STATEMENT EXECUTE PROCEDURE leases_deleted();
+                END IF;
+            END;
+            $$;
+            """)
+            self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (version INT NOT NULL);
+            DELETE FROM schema_version;
+            """)
+            self.cursor.execute("INSERT INTO schema_version (version) VALUES (%s);", (self.schema_version,))
+            self.db_connection.commit()
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.db_connection.rollback()
+            logging.error(f"Could not migrate database, failed with error: %s", error)
+            return False
+        else:
+            logging.debug("Successfully migrated database.")
+            return True
+
+    def create_server(self, server_name, network_address, network_mask, public_key, endpoint_address, endpoint_port, n_reserved_ips, allowed_ips, peer_ttl=None):
         """
         This method creates a wireguard server that will be ready to have clients added to it upon the completion of this method.
         To achieve this create_subnet() is called from within this method, passing through the relevant parmaters.
+        If peer_ttl is given, peers that have not been seen for that many seconds will be removed by reap_expired_peers().
         Returns: HTTP Code representing result.
         """
-        sql_query = "INSERT INTO servers (serverID, public_key, endpoint_address, endpoint_port) VALUES ( %s, %s, %s, %s);"
-        sql_data = (server_name, public_key, endpoint_address, endpoint_port)
+        sql_query = "INSERT INTO servers (serverID, public_key, endpoint_address, endpoint_port, peer_ttl) VALUES ( %s, %s, %s, %s, %s);"
+        sql_data = (server_name, public_key, endpoint_address, endpoint_port, peer_ttl)
 
         if not self.validate_ip(network_address):
             logging.error(f"Could not add server {server_name}: {network_address} not a valid IP Address.")
@@ -183,16 +464,19 @@ class Wireguard_database():
         if not self.validate_port(endpoint_port):
             logging.error(f"Could not add server {server_name}: {endpoint_port} not a valid port number.")
             return 400
+        if not self.validate_peer_ttl(peer_ttl):
+            logging.error(f"Could not add server {server_name}: {peer_ttl} not a valid peer TTL.")
+            return 400
         
 
         try:
             self.cursor.execute(sql_query, sql_data)
-            self.db_connection.commit()
+            self.commit_changes()
             if not self.create_subnet(server_name, network_address, network_mask, n_reserved_ips, allowed_ips):
                 self.delete_server(server_name)
                 return 500
         except (Exception, psycopg2.DatabaseError) as error:
-            self.db_connection.rollback()
+            self.rollback_changes()
             logging.error(f"Could not add server {server_name}: %s", error)
             return 500
         else:
@@ -208,9 +492,9 @@ class Wireguard_database():
 
         try:
             self.cursor.execute(sql_query, sql_data)
-            self.db_connection.commit()
+            self.commit_changes()
         except (Exception, psycopg2.DatabaseError) as error:
-            self.db_connection.rollback()
+            self.rollback_changes()
             logging.error(f"Could not delete server {server_name}: %s", error)
             return 500
         else:
@@ -230,9 +514,9 @@ class Wireguard_database():
 
             logging.debug(server_ip)
             self.cursor.execute(sql_query, sql_data)
-            self.db_connection.commit()
+            self.commit_changes()
         except (Exception, psycopg2.DatabaseError) as error:
-            self.db_connection.rollback()
+            self.rollback_changes()
             logging.error(f"Could not add subnet for {server_name}: %s", error)
             return False
         else:
@@ -242,36 +526,82 @@ class Wireguard_database():
     def create_client(self, client_name, server_name, public_key):
         """
         This method creates a client-server peering that will be ready to connect upon the server refreshing its configuration.
-        In the case a peering already exists, this method will overwrite the old peering.
-        This method calls assign_lease() to allow for the client to connect to the server.
+        In the case a peering already exists it is kept, along with its lease, and only its public key is updated. See upsert_client().
         Returns: HTTP Code representing result.
         """
+        return self.upsert_client(client_name, server_name, public_key)[0]
+
+    def upsert_client(self, client_name, server_name, public_key):
+        """
+        This method ensures a client-server peering exists with the given public key, making as few changes as possible.
+        A repeated call with the same parameters changes nothing, and a call with a new public key updates the key in place, keeping the peering's lease.
+        A new peering is created, and leased an IP address, in a single transaction.
+        The server's subnet is locked while the peering is read, so concurrent calls for the same server, including retries of the same call, are applied one at a time.
+        Returns: A tuple of the HTTP Code representing the result (201 if the peering was created, 200 if it already existed) and the peering's lease.
+        """
         if not self.validate_wg_key(public_key):
             logging.error(f"Could not create peering {client_name}-{server_name}: Public key value \"{public_key}\" invalid.")
-            return 400
-        if not self.check_server_exists(server_name):
-            logging.error(f"Could not create peering {client_name}-{server_name}: server does not exist.")
-            return 404
+            return 400, None
 
-        sql_query = "INSERT INTO clients (client_name, public_key, serverID) VALUES ( %s, %s, %s);"
-        sql_data = (client_name, public_key, server_name,)
+        sql_peering_query = """
+        SELECT subnets.subnetID, subnets.network_address, subnets.network_mask, subnets.n_reserved_ips, subnets.n_leases, clients.clientID, clients.public_key, leases.ip_address
+        FROM subnets LEFT JOIN clients ON clients.serverID = subnets.serverID AND clients.client_name = %s
+        LEFT JOIN leases ON leases.clientID = clients.clientID
+        WHERE subnets.serverID = %s
+        FOR UPDATE OF subnets;
+        """
+        sql_peering_data = (client_name, server_name,)
+        sql_insert_query = "INSERT INTO clients (client_name, public_key, serverID) VALUES ( %s, %s, %s) RETURNING clientID;"
+        sql_update_query = "UPDATE clients SET public_key = %s WHERE clientID = %s;"
+        sql_lease_query = "INSERT INTO leases (subnetID, clientID, ip_address) VALUES ( %s, %s, %s );"
 
-        try:
-            self.delete_client_peering(client_name, server_name)
-            self.cursor.execute(sql_query, sql_data)
-            self.db_connection.commit()
-            if not self.assign_lease(client_name, server_name):
-                logging.error(f"Failed to get a lease for {client_name}.")
-                self.delete_client_peering(client_name, server_name)
-                return 500
-        except (Exception, psycopg2.DatabaseError) as error:
-            self.db_connection.rollback()
-            logging.error(f"Could not create peering {client_name}-{server_name}: %s", error)
-            return 500
-        else:
+        for attempt in range(2):
+            try:
+                self.cursor.execute(sql_peering_query, sql_peering_data)
+                peering = self.cursor.fetchone()
+                if peering == None:
+                    logging.error(f"Could not create peering {client_name}-{server_name}: server does not exist.")
+                    return 404, None
+                subnetID, network_address, network_mask, n_reserved_ips, n_leases, clientID, current_key, ip_address = peering
+                if clientID != None and current_key == public_key and ip_address != None:
+                    #Nothing was changed, so end the transaction to release the subnet lock without a commit.
+                    self.rollback_changes()
+                    logging.debug(f"Peering {client_name}-{server_name} is unchanged.")
+                    return 200, ip_address
+
+                created = clientID == None
+                if created:
+                    self.cursor.execute(sql_insert_query, (client_name, public_key, server_name,))
+                    clientID = self.cursor.fetchone()[0]
+                elif current_key != public_key:
+                    self.cursor.execute(sql_update_query, (public_key, clientID,))
+                if ip_address == None:
+                    ip_address = self.get_next_ip(server_name, (network_address, network_mask, n_reserved_ips, n_leases))
+                    if ip_address == None:
+                        logging.error(f"Failed to get a lease for {client_name}.")
+                        self.rollback_changes()
+                        return 500, None
+                    self.cursor.execute(sql_lease_query, (subnetID, clientID, ip_address,))
+                self.commit_changes()
+            except psycopg2.IntegrityError as error:
+                self.rollback_changes()
+                #A call that waited for the subnet lock still reads the peering as it was before the lock was released, so it can collide with the peering the other call committed.
+                #Reading again sees that peering.
+                if attempt == 0 and error.pgcode == psycopg2.errorcodes.UNIQUE_VIOLATION:
+                    logging.debug(f"Peering {client_name}-{server_name} changed concurrently, retrying.")
+                    continue
+                logging.error(f"Could not create peering {client_name}-{server_name}: %s", error)
+                return 500, None
+            except (Exception, psycopg2.DatabaseError) as error:
+                self.rollback_changes()
+                logging.error(f"Could not create peering {client_name}-{server_name}: %s", error)
+                return 500, None
+            break
+        if created:
             logging.debug(f"Successfully added peering: {client_name}-{server_name}.")
-            return 201
-        
+            return 201, ip_address
+        logging.debug(f"Successfully updated peering: {client_name}-{server_name}.")
+        return 200, ip_address
 
     def delete_client(self, client_name):
         """
@@ -283,9 +613,9 @@ class Wireguard_database():
 
         try:
             self.cursor.execute(sql_query, sql_data)
-            self.db_connection.commit()
+            self.commit_changes()
         except (Exception, psycopg2.DatabaseError) as error:
-            self.db_connection.rollback()
+            self.rollback_changes()
             logging.error(f"Could not delete client {client_name}.: %s", error)
             return 500
         else:
@@ -303,9 +633,9 @@ class Wireguard_database():
 
         try:
             self.cursor.execute(sql_query, sql_data)
-            self.db_connection.commit()
+            self.commit_changes()
         except (Exception, psycopg2.DatabaseError) as error:
-            self.db_connection.rollback()
+            self.rollback_changes()
             logging.error(f"Could not delete client-server peering of {client_name}-{server_name}.: %s", error)
             return 500
         else:
@@ -315,7 +645,7 @@ class Wireguard_database():
     def assign_lease(self, client_name, server_name):
         """
         This method will assign a wireguard IP address to a client that will be used to communicate to the server within the wireguard session.
-        This method should not be called directly as it is called from within the create_client() method.
+        This method should not be called directly as create_client() assigns leases to the peerings it creates.
         """
         ip_address = self.get_next_ip(server_name)
         if ip_address == None:
@@ -327,30 +657,37 @@ class Wireguard_database():
 
         try:
             self.cursor.execute(sql_query, sql_data)
-            self.db_connection.commit()
+            self.commit_changes()
         except (Exception, psycopg2.DatabaseError) as error:
-            self.db_connection.rollback()
+            self.rollback_changes()
             logging.error(f"Could not assign lease to client {client_name}: %s", error)
             return False
         else:
             logging.debug(f"Successfully added client: {client_name}.")
             return True
 
-    def get_next_ip(self, server_name):
+    def get_next_ip(self, server_name, subnet_details=None):
         """
         This method returns the next unassigned IP address from the subnet owned by a server.
+        subnet_details may be given as the subnet's (network_address, network_mask, n_reserved_ips, n_leases) if they have already been read.
         """
 
         sql_reserved_ips_query = "SELECT leases.ip_address FROM subnets INNER JOIN leases ON subnets.subnetID = leases.subnetID WHERE subnets.serverID = %s;"
         sql_reserved_ips_data = (server_name,)
-        sql_subnet_details_query = "SELECT network_address, network_mask, n_reserved_ips FROM subnets WHERE serverID = %s;"
+        sql_subnet_details_query = "SELECT network_address, network_mask, n_reserved_ips, n_leases FROM subnets WHERE serverID = %s;"
         sql_subnet_details_data = (server_name,)
 
         try:
+            if subnet_details == None:
+                self.cursor.execute(sql_subnet_details_query, sql_subnet_details_data)
+                subnet_details = self.cursor.fetchone()
+            network_address, network_mask, n_reserved_ips, n_leases = subnet_details
+            #A full subnet is known from its lease count, without reading every lease.
+            if n_leases >= self.count_usable_ips(network_mask, n_reserved_ips):
+                logging.error(f"No free IP addresses left in subnet of {server_name}.")
+                return None
             self.cursor.execute(sql_reserved_ips_query, sql_reserved_ips_data)
             taken_ips = self.cursor.fetchall()
-            self.cursor.execute(sql_subnet_details_query, sql_subnet_details_data)
-            network_address, network_mask, n_reserved_ips = self.cursor.fetchone()
         except (Exception, psycopg2.DatabaseError) as error:
             logging.error(f"Failed to retrieve details of subnet for client {server_name}: %s", error)
         subnet = ipaddress.ip_network(f"{network_address}/{network_mask}")
@@ -367,10 +704,49 @@ class Wireguard_database():
             ipaddr_str = (str(ipaddr),)
             ipaddr = ipaddress.ip_address(ipaddr)
             if not ipaddr_str in taken_ips and ipaddr > subnet[n_reserved_ips] and ipaddr != subnet[-1]:
-                return ipaddr_str
+                return str(ipaddr)
         
         return None
 
+    def count_usable_ips(self, network_mask, n_reserved_ips):
+        """
+        Returns the number of addresses in a subnet that can be leased to clients.
+        This excludes the network and broadcast addresses, and the reserved addresses at the start of the subnet.
+        """
+        return max(0, 2 ** (32 - network_mask) - n_reserved_ips - 2)
+
+    def get_capacity(self, server_name=None):
+        """
+        Returns the used, free and reserved addresses, and the most ever used, of the subnet of a server, or of every server if none is given.
+        Counts are maintained as leases are added and removed, so this does not read the leases table.
+        Returns None if the given server does not exist, and False if the database could not be read, as {} means there are no servers.
+        """
+        sql_query = "SELECT serverID, network_address, network_mask, n_reserved_ips, n_leases, high_water FROM subnets"
+        sql_data = ()
+        if server_name != None:
+            sql_query += " WHERE serverID = %s"
+            sql_data = (server_name,)
+
+        try:
+            self.cursor.execute(sql_query + ";", sql_data)
+            subnets = self.cursor.fetchall()
+        except (Exception, psycopg2.DatabaseError) as error:
+            logging.error(f"Could not pull subnet capacity from database: %s", error)
+            return False
+        if server_name != None and len(subnets) == 0:
+            return None
+        response = {}
+        for subnet in subnets:
+            usable = self.count_usable_ips(subnet[2], subnet[3])
+            response[subnet[0]] = {
+                "subnet": f"{subnet[1]}/{subnet[2]}",
+                "used": subnet[4],
+                "free": max(0, usable - subnet[4]),
+                "reserved": 2 ** (32 - subnet[2]) - usable,
+                "high_water": subnet[5]
+            }
+        return response
+
     def list_clients(self):
         """
         Returns all columns of all rows within the clients table.
@@ -466,6 +842,8 @@ class Wireguard_database():
         if not self.check_client_exists(client_name, server_name):
             return None
         clientID = self.get_client_id(client_name, server_name)
+        #Fetching a config counts as the client being seen, limited to one write a minute per client, and only written if the peering can expire.
+        self.touch_client(client_name, server_name, min_interval=60, expiring_only=True)
 
         sql_server_query = "SELECT public_key, endpoint_address, endpoint_port FROM servers WHERE serverID = %s;"
         sql_server_data = (server_name,)
@@ -507,6 +885,163 @@ class Wireguard_database():
             response["peers"] += [{"public_key": client[1], "ip_address": client[2]}]
         return response
 
+    def search_clients(self, client_name_prefix=None, server_name=None, public_key=None, address=None, limit=100):
+        """
+        Returns the client-server peerings matching every filter given, each with its lease.
+        address may be a single IP address or a network in CIDR notation, matching any lease within it.
+        Every filter is served by an index, so a search does not scan the clients or leases tables.
+        Returns None if no filter is given or a filter is invalid, and {} if the database could not be searched.
+        """
+        conditions = []
+        sql_data = []
+        if client_name_prefix:
+            #Escape LIKE wildcards so the prefix is matched literally.
+            conditions.append("clients.client_name LIKE %s")
+            sql_data.append(client_name_prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+        if server_name:
+            conditions.append("clients.serverID = %s")
+            sql_data.append(server_name)
+        if public_key:
+            conditions.append("clients.public_key = %s")
+            sql_data.append(public_key)
+        if address:
+            try:
+                network = ipaddress.IPv4Network(address, strict=False)
+            except (Exception, ValueError):
+                logging.error(f"Could not search clients: {address} not a valid IP Address or network.")
+                return None
+            conditions.append("leases.ip_address::inet <<= %s::inet")
+            sql_data.append(str(network))
+        if len(conditions) == 0 or not self.validate_limit(limit):
+            logging.error(f"Could not search clients: no filters, or an invalid limit of {limit}, given.")
+            return None
+
+        sql_query = f"SELECT clients.clientID, clients.client_name, clients.serverID, clients.public_key, leases.ip_address FROM clients LEFT JOIN leases ON clients.clientID = leases.clientID WHERE {' AND '.join(conditions)} ORDER BY clients.clientID LIMIT %s;"
+        sql_data.append(limit)
+
+        try:
+            self.cursor.execute(sql_query, sql_data)
+            clients = self.cursor.fetchall()
+        except (Exception, psycopg2.DatabaseError) as error:
+            logging.error(f"Could not search clients: %s", error)
+            return {}
+        return {"clients": [{"client_name": client[1], "peering": client[0], "server": client[2], "public_key": client[3], "ip_address": client[4]} for client in clients]}
+
+    def get_server_config_revision(self, server_name):
+        """
+        Returns the number of times the peer list of a server has changed, or None if the server does not exist.
+        Servers can compare this against the revision they last applied to skip unchanged configs.
+        """
+        sql_query = "SELECT config_revision FROM servers WHERE serverID = %s;"
+        sql_data = (server_name,)
+
+        try:
+            self.cursor.execute(sql_query, sql_data)
+            revision = self.cursor.fetchone()
+        except (Exception, psycopg2.DatabaseError) as error:
+            logging.error(f"Could not pull config revision of {server_name} from database: %s", error)
+            return None
+        if revision == None:
+            return None
+        return revision[0]
+
+    def set_peer_ttl(self, server_name, peer_ttl):
+        """
+        Sets the number of seconds a server's peers may go unseen before reap_expired_peers() removes them. A peer_ttl of None disables expiry.
+        Returns: HTTP Code representing result.
+        """
+        if not self.validate_peer_ttl(peer_ttl):
+            logging.error(f"Could not set peer TTL of {server_name}: {peer_ttl} not a valid peer TTL.")
+            return 400
+
+        sql_query = "UPDATE servers SET peer_ttl = %s WHERE serverID = %s;"
+        sql_data = (peer_ttl, server_name,)
+        #Peers of a server without a TTL are not marked as seen when they fetch their config, so they are all marked as seen when expiry is first enabled.
+        sql_reset_query = """
+        UPDATE clients SET last_seen = now() FROM servers
+        WHERE servers.serverID = clients.serverID AND servers.serverID = %s AND servers.peer_ttl IS NULL AND %s IS NOT NULL;
+        """
+        sql_reset_data = (server_name, peer_ttl,)
+
+        try:
+            self.cursor.execute(sql_reset_query, sql_reset_data)
+            self.cursor.execute(sql_query, sql_data)
+            updated = self.cursor.rowcount
+            self.commit_changes()
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.rollback_changes()
+            logging.error(f"Could not set peer TTL of {server_name}: %s", error)
+            return 500
+        if updated == 0:
+            return 404
+        logging.debug(f"Successfully set peer TTL of {server_name} to {peer_ttl}.")
+        return 200
+
+    def touch_client(self, client_name, server_name, min_interval=0, expiring_only=False):
+        """
+        Records that a client-server peering has just been seen, delaying its expiry.
+        If min_interval is given, the peering is only updated if it has not been seen within that many seconds.
+        If expiring_only is True, the peering is only updated if its server has a peer TTL, so peerings that never expire cost no write.
+        Returns: HTTP Code representing result, 404 if no peering was updated.
+        """
+        sql_query = """
+        UPDATE clients SET last_seen = now() FROM servers
+        WHERE servers.serverID = clients.serverID AND clients.client_name = %s AND clients.serverID = %s AND clients.last_seen <= now() - %s * interval '1 second'
+        AND (servers.peer_ttl IS NOT NULL OR NOT %s);
+        """
+        sql_data = (client_name, server_name, min_interval, expiring_only,)
+
+        try:
+            self.cursor.execute(sql_query, sql_data)
+            updated = self.cursor.rowcount
+            #Nothing to save when no peering was updated, so the commit is skipped.
+            if updated > 0:
+                self.commit_changes()
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.rollback_changes()
+            logging.error(f"Could not update last seen time of {client_name}-{server_name}: %s", error)
+            return 500
+        if updated == 0:
+            return 404
+        return 200
+
+    def reap_expired_peers(self, batch_size=500):
+        """
+        Deletes every client-server peering that has not been seen within its server's peer TTL, freeing its lease.
+        Peerings are deleted in batches of at most batch_size, each in its own transaction, so the reaper never holds long locks.
+        Returns: The number of leases reclaimed, or None if reaping failed, for example because the connection was lost.
+        """
+        sql_query = """
+        WITH expired AS (
+            DELETE FROM clients WHERE clientID IN (
+                SELECT clients.clientID FROM clients INNER JOIN servers ON clients.serverID = servers.serverID
+                WHERE servers.peer_ttl IS NOT NULL AND clients.last_seen < now() - servers.peer_ttl * interval '1 second'
+                LIMIT %s FOR UPDATE OF clients SKIP LOCKED)
+            RETURNING clientID)
+        SELECT (SELECT COUNT(*) FROM expired), (SELECT COUNT(*) FROM leases WHERE clientID IN (SELECT clientID FROM expired));
+        """
+        sql_data = (batch_size,)
+        reclaimed_leases = 0
+
+        try:
+            while True:
+                self.cursor.execute(sql_query, sql_data)
+                expired_peers, expired_leases = self.cursor.fetchone()
+                self.db_connection.commit()
+                reclaimed_leases += expired_leases
+                if expired_peers < batch_size:
+                    break
+        except (Exception, psycopg2.DatabaseError) as error:
+            logging.error(f"Could not reap expired peers after reclaiming {reclaimed_leases} leases: %s", error)
+            #The rollback fails too if the connection was lost, which must not stop the caller from reconnecting.
+            try:
+                self.db_connection.rollback()
+            except (Exception, psycopg2.DatabaseError):
+                pass
+            return None
+        logging.debug(f"Reclaimed {reclaimed_leases} leases from expired peers.")
+        return reclaimed_leases
+
     def check_server_exists(self, server_name):
         """ Checks if a server exists """
         sql_query = "SELECT COUNT(serverID) FROM servers WHERE serverID = %s;"
@@ -558,6 +1093,20 @@ class Wireguard_database():
         except Exception:
             return False
 
+    def validate_limit(self, limit):
+        """ Checks if a search limit is within the valid range. """
+        try:
+            return int(limit) == limit and limit > 0 and limit <= 1000
+        except Exception:
+            return False
+
+    def validate_peer_ttl(self, peer_ttl):
+        """ Checks if a peer TTL is either unset or a positive number of seconds. """
+        try:
+            return peer_ttl == None or (int(peer_ttl) == peer_ttl and peer_ttl > 0)
+        except Exception:
+            return False
+
     def get_server_wireguard_ip(self, server_name):
         """ Returns the IP address assigned to a server for use within its wireguard session. """
         subnetID = self.get_subnet_id(server_name)
@@ -572,3 +1121,208 @@ class Wireguard_database():
         except (Exception, psycopg2.DatabaseError) as error:
             logging.error(f"Could not pull servers wireguard ip from database: %s", error)
         return response
+
+
+    def commit_changes(self):
+        """ Commits the changes made by an operation. Within run_batch() changes are committed once the whole batch has run. """
+        if not self.batching:
+            self.db_connection.commit()
+
+    def rollback_changes(self):
+        """ Discards the changes made by an operation. Within run_batch() only the current operation's changes are discarded. """
+        if self.batching:
+            self.cursor.execute("ROLLBACK TO SAVEPOINT batch_operation;")
+        else:
+            self.db_connection.rollback()
+
+    def run_batch(self, operations):
+        """
+        Runs a list of (method_name, args) write operations, such as ("upsert_client", (client_name, server_name, public_key)), in a single transaction with a single commit.
+        Each operation runs within its own savepoint, so an operation that fails discards only its own changes and the rest of the batch is unaffected.
+        Returns: The result of each operation, in order, or None if the batch could not be committed, in which case none of its changes were made.
+        """
+        results = []
+
+        try:
+            self.db_connection.rollback()
+            self.batching = True
+            for method_name, args in operations:
+                self.cursor.execute("SAVEPOINT batch_operation;")
+                results.append(getattr(self, method_name)(*args))
+                self.cursor.execute("RELEASE SAVEPOINT batch_operation;")
+            self.batching = False
+            self.db_connection.commit()
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.batching = False
+            self.db_connection.rollback()
+            logging.error(f"Could not run batch of {len(operations)} operations: %s", error)
+            return None
+        else:
+            logging.debug(f"Successfully ran batch of {len(operations)} operations.")
+            return results
+
+    def end_transaction(self):
+        """ Ends the current transaction without saving anything, releasing the locks held by any reads made in it. Changes are always committed by the method making them. """
+        self.db_connection.rollback()
+
+    def close(self):
+        """ Closes the connection to the database, after which this object can no longer be used. """
+        self.db_connection.close()
+
+    def listen_for_config_changes(self):
+        """
+        Subscribes to the notifications sent whenever a server, or its peer list, changes.
+        The connection is switched to autocommit so notifications are delivered as soon as they are sent, so it should be used for nothing else.
+        """
+        self.db_connection.autocommit = True
+        self.cursor.execute("LISTEN config_changed;")
+
+    def poll_config_changes(self, timeout):
+        """
+        Waits up to timeout seconds for notifications subscribed to with listen_for_config_changes().
+        Returns: The names of the servers that changed, None in place of a name if every server may have changed, or an empty list if there were none.
+        Raises: psycopg2.Error if the connection to the database is lost.
+        """
+        if select.select([self.db_connection], [], [], timeout) == ([], [], []):
+            return []
+        self.db_connection.poll()
+        changed_servers = [notify.payload if notify.payload else None for notify in self.db_connection.notifies]
+        self.db_connection.notifies.clear()
+        return changed_servers
+
+    def start_query_tracking(self, stats=None):
+        """
+        Starts counting the database work done by the calling thread on this connection, against stats if given, e.g. to count a request's work on whichever connection it is lent.
+        Returns: The Query_stats the work is counted against.
+        """
+        if stats == None:
+            stats = Query_stats()
+        stats.previous = self.db_connection.tracked_stats()
+        self.db_connection.tracking.stats = stats
+        return stats
+
+    def stop_query_tracking(self, stats):
+        """
+        Stops counting against stats, which was returned by start_query_tracking(). The counts are added to any tracking it was nested within.
+        """
+        self.db_connection.tracking.stats = stats.previous
+        if stats.previous != None:
+            stats.previous.add(stats)
+
+    @contextmanager
+    def track_queries(self):
+        """
+        Counts the database work done by the calling thread within a with block, e.g.
+        with wireguard_state.track_queries() as stats:
+            wireguard_state.create_client(...)
+        """
+        stats = self.start_query_tracking()
+        try:
+            yield stats
+        finally:
+            self.stop_query_tracking(stats)
+
+    def export_snapshot(self, snapshot_file):
+        """
+        Writes every row of the servers, subnets, clients and leases tables to a binary file object.
+        All tables are read within a single repeatable read transaction so the snapshot is consistent.
+        Each table is written as a header line of "<table> <column>,<column>..." followed by the rows in postgres COPY text format and a "\\." terminator line.
+        Returns: HTTP Code representing result.
+        """
+        try:
+            #End any transaction left open by earlier reads so the isolation level can be set.
+            self.db_connection.rollback()
+            self.cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY;")
+            for table, columns in self.snapshot_tables:
+                snapshot_file.write(f"{table} {','.join(columns)}\n".encode())
+                sql_query = psycopg2.sql.SQL("COPY {} ({}) TO STDOUT;").format(
+                    psycopg2.sql.Identifier(table.lower()),
+                    psycopg2.sql.SQL(",").join(psycopg2.sql.Identifier(column.lower()) for column in columns))
+                self.cursor.copy_expert(sql_query, snapshot_file)
+                snapshot_file.write(b"\\.\n")
+            self.db_connection.rollback()
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.db_connection.rollback()
+            logging.error(f"Could not export snapshot: %s", error)
+            return 500
+        else:
+            logging.debug("Successfully exported snapshot.")
+            return 200
+
+    def import_snapshot(self, snapshot_file):
+        """
+        Replaces the contents of the servers, subnets, clients and leases tables with a snapshot written by export_snapshot().
+        Rows are streamed into postgres one section at a time, so memory use does not grow with the size of the snapshot.
+        The whole import is a single transaction; if any part of it fails the database is left untouched.
+        Returns: HTTP Code representing result.
+        """
+        known_tables = dict(self.snapshot_tables)
+
+        try:
+            self.db_connection.rollback()
+            self.cursor.execute("TRUNCATE servers, subnets, clients, leases;")
+            header = snapshot_file.readline()
+            while header.strip():
+                table, _, columns = header.decode().strip().partition(" ")
+                columns = columns.split(",")
+                if table not in known_tables or not set(columns) <= set(known_tables[table]):
+                    raise ValueError(f"unexpected snapshot section \"{header.decode().strip()}\"")
+                sql_query = psycopg2.sql.SQL("COPY {} ({}) FROM STDIN;").format(
+                    psycopg2.sql.Identifier(table.lower()),
+                    psycopg2.sql.SQL(",").join(psycopg2.sql.Identifier(column.lower()) for column in columns))
+                section = Snapshot_section(snapshot_file)
+                self.cursor.copy_expert(sql_query, section)
+                if not section.complete:
+                    raise ValueError(f"snapshot section {table} was truncated")
+                header = snapshot_file.readline()
+            #Rows were loaded with their original IDs, so move each sequence past the highest ID restored.
+            for table, column in self.snapshot_sequences:
+                sql_query = psycopg2.sql.SQL("SELECT setval(pg_get_serial_sequence(%s, %s), COALESCE(MAX({}), 0) + 1, false) FROM {};").format(
+                    psycopg2.sql.Identifier(column.lower()), psycopg2.sql.Identifier(table))
+                self.cursor.execute(sql_query, (table, column.lower()))
+            #Truncating and copying fires no row triggers, so every server's cached config is invalidated at once.
+            self.cursor.execute("NOTIFY config_changed;")
+            self.db_connection.commit()
+            self.cursor.execute("ANALYZE servers, subnets, clients, leases;")
+            self.db_connection.commit()
+        except (ValueError, UnicodeDecodeError, psycopg2.DataError, psycopg2.IntegrityError) as error:
+            self.db_connection.rollback()
+            logging.error(f"Could not import snapshot, snapshot is invalid: %s", error)
+            return 400
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.db_connection.rollback()
+            logging.error(f"Could not import snapshot: %s", error)
+            return 500
+        else:
+            logging.debug("Successfully imported snapshot.")
+            return 200
+
+class Snapshot_section():
+    """
+    Wraps a binary snapshot file so that psycopg2's copy_expert() reads only the rows of the current table.
+    Reading stops at the "\\." terminator line, leaving the file positioned at the next section header.
+
+    Attributes
+    ----------
+    complete : bool
+        Whether the terminator line for this section has been read.
+    """
+    def __init__(self, snapshot_file):
+        self.snapshot_file = snapshot_file
+        self.buffer = b""
+        self.complete = False
+
+    def read(self, size=-1):
+        while not self.complete and (size < 0 or len(self.buffer) < size):
+            line = self.snapshot_file.readline()
+            if line == b"" or line.rstrip(b"\r\n") == b"\\.":
+                self.complete = line != b""
+                break
+            self.buffer += line
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
@@ -0,0 +1,221 @@
+import logging, os, signal, socket, threading, time
+
+class Connection_pool():
+    """
+    Lends each thread a connection from a bounded pool the first time it uses one, while looking like a single connection to the caller.
+    Attribute lookups are passed to the calling thread's connection, so code written against one shared connection needs no changes.
+    A thread keeps its connection until it calls release(), after which other threads reuse it. At most size connections exist at once.
+
+    Attributes
+    ----------
+    factory : function
+        Creates a new connection, raising an exception if it cannot.
+    size : int
+        The most connections that may exist at once.
+    timeout : float
+        The longest, in seconds, a thread waits for a connection to be released when all of them are lent out.
+    on_checkout : function
+        Called with every connection lent to a thread.
+
+    Methods
+    -------
+    connection()
+        Returns the calling thread's connection, borrowing one if needed.
+    current()
+        Returns the calling thread's connection, if it has one.
+    release()
+        Returns the calling thread's connection to the pool.
+    discard()
+        Closes the calling thread's connection instead of returning it to the pool, so a new one is created in its place.
+    """
+    def __init__(self, factory, size=4, timeout=5, on_checkout=None):
+        """
+        Parameters
+        ----------
+        factory : function
+            Creates a new connection, raising an exception if it cannot.
+        size : int
+            The most connections that may exist at once (default is 4)
+        timeout : float
+            The longest a thread waits for a connection to be released (default is 5)
+        on_checkout : function
+            Called with every connection lent to a thread (default is None)
+        """
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self.on_checkout = on_checkout
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.idle = []
+        self.connections = threading.local()
+
+    def connection(self):
+        """
+        Returns the calling thread's connection, borrowing an idle one, or creating one, if it has none.
+        Raises: TimeoutError if no connection is released within timeout seconds, or the factory's exception if a connection cannot be created.
+        """
+        connection = self.current()
+        if connection != None:
+            return connection
+        if not self.slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"no connection was released within {self.timeout} seconds")
+        try:
+            with self.lock:
+                connection = self.idle.pop() if len(self.idle) > 0 else None
+            if connection == None:
+                connection = self.factory()
+        except Exception:
+            self.slots.release()
+            raise
+        self.connections.connection = connection
+        if self.on_checkout != None:
+            self.on_checkout(connection)
+        return connection
+
+    def current(self):
+        """ Returns the calling thread's connection, or None if it has not borrowed one. """
+        return getattr(self.connections, "connection", None)
+
+    def release(self):
+        """ Returns the calling thread's connection to the pool. Any transaction on it should be ended first. """
+        connection = self.current()
+        if connection == None:
+            return
+        self.connections.connection = None
+        with self.lock:
+            self.idle.append(connection)
+        self.slots.release()
+
+    def discard(self):
+        """ Closes the calling thread's connection, for example once it has been lost, and frees its place in the pool. """
+        connection = self.current()
+        if connection == None:
+            return
+        self.connections.connection = None
+        self.slots.release()
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def __getattr__(self, name):
+        return getattr(self.connection(), name)
+
+class Config_cache():
+    """
+    Caches configs built from the database until they are invalidated.
+    Every invalidation moves the cache to a new generation; a value read from the database before an invalidation is discarded instead of cached, so a slow read can never overwrite a newer invalidation.
+    The cache is disabled until enable() is called, and should be disabled whenever invalidations may be missed.
+
+    Methods
+    -------
+    get()
+        Returns a cached value.
+    generation()
+        Returns the current generation, to be passed to put().
+    put()
+        Caches a value if there has been no invalidation since it was read.
+    invalidate()
+        Discards a cached value, or every cached value.
+    enable()
+        Starts caching values.
+    disable()
+        Discards every cached value and stops caching.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.current_generation = 0
+        self.enabled = False
+
+    def get(self, key):
+        """ Returns the cached value for key, or None. """
+        with self.lock:
+            return self.values.get(key) if self.enabled else None
+
+    def generation(self):
+        """ Returns the current generation. Call this before reading a value from the database. """
+        with self.lock:
+            return self.current_generation
+
+    def put(self, key, value, generation):
+        """ Caches value for key, unless the cache has been invalidated since generation was taken. """
+        with self.lock:
+            if self.enabled and generation == self.current_generation:
+                self.values[key] = value
+
+    def invalidate(self, key=None):
+        """ Discards the cached value for key, or every cached value if no key is given. """
+        with self.lock:
+            self.current_generation += 1
+            if key == None:
+                self.values.clear()
+            else:
+                self.values.pop(key, None)
+
+    def enable(self):
+        with self.lock:
+            self.enabled = True
+
+    def disable(self):
+        with self.lock:
+            self.enabled = False
+            self.current_generation += 1
+            self.values.clear()
+
+def serve_workers(serve_worker, host, port, n_workers, restart_delay=1):
+    """
+    Binds a listening socket then forks n_workers processes that accept connections from it, restarting any worker that exits.
+    Each worker calls serve_worker(listening_socket, worker_index), which should not return while the worker is serving.
+    Nothing that holds a database connection or a thread should be created before this is called, as neither survives a fork.
+    Returns once every worker has exited after the supervisor receives SIGTERM or SIGINT.
+    """
+    listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listening_socket.bind((host, port))
+    listening_socket.listen(1024)
+    workers = {}
+    stopping = False
+
+    def spawn(worker_index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                serve_worker(listening_socket, worker_index)
+            except Exception:
+                logging.exception(f"Worker {worker_index} failed.")
+                os._exit(1)
+            os._exit(0)
+        workers[pid] = worker_index
+        logging.info(f"Started worker {worker_index} with pid {pid}.")
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for worker_index in range(n_workers):
+        spawn(worker_index)
+
+    while len(workers) > 0:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker_index = workers.pop(pid, None)
+        if worker_index == None or stopping:
+            continue
+        logging.error(f"Worker {worker_index} with pid {pid} exited with status {status}, restarting.")
+        time.sleep(restart_delay)
+        if not stopping:
+            spawn(worker_index)
+    listening_socket.close()
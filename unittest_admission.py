@@ -0,0 +1,83 @@
+from app.admission import Token_bucket, Admission_controller
+import unittest
+
+class fake_clock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class unittest_admission(unittest.TestCase):
+
+    def test_token_bucket_burst(self):
+        clock = fake_clock()
+        bucket = Token_bucket(1, 2, clock)
+        result = [bucket.take(), bucket.take(), bucket.take()]
+        self.assertEqual([0, 0, 1], result)
+
+    def test_token_bucket_refill(self):
+        clock = fake_clock()
+        bucket = Token_bucket(2, 1, clock)
+        bucket.take()
+        clock.now = 0.5
+        result = bucket.take()
+        self.assertEqual(0, result)
+
+    def test_admit_expected(self):
+        controller = Admission_controller()
+        result = controller.admit("client1", "reads")
+        controller.release("reads")
+        self.assertEqual((200, 0), result)
+
+    def test_admit_caller_rate_limited(self):
+        clock = fake_clock()
+        controller = Admission_controller(caller_rate=1, clock=clock)
+        controller.admit("client1", "reads")
+        controller.release("reads")
+        result = controller.admit("client1", "reads")
+        other_caller = controller.admit("client2", "reads")
+        self.assertEqual(((429, 1), (200, 0)), (result, other_caller))
+
+    def test_admit_global_rate_limited(self):
+        clock = fake_clock()
+        controller = Admission_controller(global_rate=0.5, clock=clock)
+        controller.admit("client1", "reads")
+        controller.release("reads")
+        result = controller.admit("client2", "reads")
+        self.assertEqual((429, 2), result)
+
+    def test_admit_class_limit_sheds(self):
+        controller = Admission_controller(class_limits={"bulk": 1}, queue_timeout=0.01)
+        controller.admit("client1", "bulk")
+        result = controller.admit("client2", "bulk")
+        provisioning = controller.admit("client3", "provisioning")
+        self.assertEqual(((503, 1), (200, 0)), (result, provisioning))
+
+    def test_admit_max_in_flight_sheds(self):
+        controller = Admission_controller(max_in_flight=1, queue_timeout=0.01)
+        controller.admit("client1", "provisioning")
+        result = controller.admit("client2", "reads")
+        controller.release("provisioning")
+        after_release = controller.admit("client2", "reads")
+        self.assertEqual(((503, 1), (200, 0)), (result, after_release))
+
+    def test_admit_separate_class(self):
+        controller = Admission_controller(priorities=("batched_writes", "provisioning"), class_limits={"batched_writes": 2}, max_in_flight=1, separate_classes=("batched_writes",), queue_timeout=0.01)
+        results = [controller.admit("client1", "provisioning"), controller.admit("client2", "batched_writes"), controller.admit("client3", "batched_writes"), controller.admit("client4", "batched_writes")]
+        self.assertEqual([(200, 0), (200, 0), (200, 0), (503, 1)], results)
+
+    def test_admit_higher_priority_waiting(self):
+        controller = Admission_controller(max_in_flight=1)
+        controller.waiting["provisioning"] = 1
+        controller.queue_timeout = 0.01
+        result = controller.admit("client1", "bulk")
+        self.assertEqual((503, 1), result)
+
+    def test_admit_queue_full(self):
+        controller = Admission_controller(max_queued=0)
+        result = controller.admit("client1", "reads")
+        self.assertEqual((503, 1), result)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+from app.coalescer import Write_coalescer
+import unittest, threading, time
+
+class fake_database():
+    def __init__(self, fail_batches_over=None):
+        self.batches = []
+        self.fail_batches_over = fail_batches_over
+
+    def run_batch(self, operations):
+        self.batches.append(operations)
+        if self.fail_batches_over != None and len(operations) > self.fail_batches_over:
+            return None
+        return [(201, args[0]) if method_name == "upsert_client" else 200 for method_name, args in operations]
+
+class unittest_coalescer(unittest.TestCase):
+
+    def submit_concurrently(self, coalescer, operations):
+        results = [None] * len(operations)
+        def submit(index):
+            results[index] = coalescer.submit(*operations[index])
+        threads = [threading.Thread(target=submit, args=(index,)) for index in range(len(operations))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_single_write(self):
+        database = fake_database()
+        coalescer = Write_coalescer(lambda: database, window=0.001)
+        result = coalescer.submit("delete_client_peering", "testclient01", "wireguard01")
+        self.assertEqual((200, 1), (result, len(database.batches)))
+
+    def test_concurrent_writes_batched(self):
+        database = fake_database()
+        coalescer = Write_coalescer(lambda: database, window=0.5, batch_size=8)
+        operations = [("upsert_client", f"testclient{index}", "wireguard01", "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=") for index in range(8)]
+        results = self.submit_concurrently(coalescer, operations)
+        self.assertEqual(([(201, f"testclient{index}") for index in range(8)], 1), (results, len(database.batches)))
+
+    def test_batch_size_limit(self):
+        database = fake_database()
+        coalescer = Write_coalescer(lambda: database, window=0.5, batch_size=3)
+        operations = [("delete_client_peering", f"testclient{index}", "wireguard01") for index in range(6)]
+        self.submit_concurrently(coalescer, operations)
+        self.assertTrue(all(len(batch) <= 3 for batch in database.batches))
+
+    def test_failed_batch_retried_individually(self):
+        database = fake_database(fail_batches_over=1)
+        coalescer = Write_coalescer(lambda: database, window=0.5, batch_size=4)
+        operations = [("delete_client_peering", f"testclient{index}", "wireguard01") for index in range(4)]
+        results = self.submit_concurrently(coalescer, operations)
+        self.assertEqual([200, 200, 200, 200], results)
+
+    def test_failed_write_raises(self):
+        database = fake_database(fail_batches_over=0)
+        coalescer = Write_coalescer(lambda: database, window=0.001)
+        with self.assertRaises(Exception):
+            coalescer.submit("delete_client_peering", "testclient01", "wireguard01")
+
+    def test_stuck_writer_times_out(self):
+        blocked = threading.Event()
+        class stuck_database(fake_database):
+            def run_batch(self, operations):
+                blocked.wait()
+                return super().run_batch(operations)
+        coalescer = Write_coalescer(lambda: stuck_database(), window=0.001, timeout=0.05)
+        with self.assertRaises(TimeoutError):
+            coalescer.submit("delete_client_peering", "testclient01", "wireguard01")
+        blocked.set()
+
+    def test_reconnect_closes_lost_connection(self):
+        connections = []
+        class closable_database(fake_database):
+            closed = False
+            def close(self):
+                self.closed = True
+        def connect():
+            connections.append(closable_database(fail_batches_over=0))
+            return connections[-1]
+        coalescer = Write_coalescer(connect, window=0.001)
+        with self.assertRaises(Exception):
+            coalescer.submit("delete_client_peering", "testclient01", "wireguard01")
+        #The writer closes the lost connection just before it reconnects.
+        deadline = time.monotonic() + 1
+        while len(connections) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual((2, True), (len(connections), connections[0].closed))
+
+if __name__ == '__main__':
+    unittest.main()
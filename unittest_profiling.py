@@ -0,0 +1,54 @@
+from app.profiling import Request_profiler
+import unittest, marshal, time
+
+def hello_app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    time.sleep(0.05)
+    return [b"hello"]
+
+def call(app, path):
+    return b"".join(app({"PATH_INFO": path}, lambda status, headers: None))
+
+class unittest_profiling(unittest.TestCase):
+
+    def test_unsampled_passthrough(self):
+        profiler = Request_profiler(hello_app)
+        result = call(profiler, "/api/v1/server/list_all")
+        self.assertEqual((b"hello", None), (result, profiler.dump_pstats()))
+
+    def test_cprofile_sampled_path(self):
+        profiler = Request_profiler(hello_app, sample_rates={"/api/v1/server/list_all": 1.0})
+        call(profiler, "/api/v1/server/list_all")
+        call(profiler, "/api/v1/client/list_all")
+        stats = marshal.loads(profiler.dump_pstats("/api/v1/server/list_all"))
+        functions = [function[2] for function in stats]
+        self.assertEqual((True, None), ("hello_app" in functions, profiler.dump_pstats("/api/v1/client/list_all")))
+
+    def test_cprofile_aggregates_requests(self):
+        profiler = Request_profiler(hello_app, default_rate=1.0)
+        call(profiler, "/api/v1/server/list_all")
+        call(profiler, "/api/v1/server/list_all")
+        stats = marshal.loads(profiler.dump_pstats())
+        calls = [stat[1] for function, stat in stats.items() if function[2] == "hello_app"]
+        self.assertEqual([2], calls)
+
+    def test_wall_samples_folded(self):
+        profiler = Request_profiler(hello_app, mode="wall", default_rate=1.0, interval=0.001)
+        profiler.start()
+        call(profiler, "/api/v1/server/list_all")
+        profiler.stop()
+        lines = profiler.dump_folded().splitlines()
+        self.assertTrue(len(lines) > 0 and all(line.startswith("/api/v1/server/list_all;") and ":hello_app" in line for line in lines))
+
+    def test_configure_bad_rate(self):
+        profiler = Request_profiler(hello_app)
+        with self.assertRaises(ValueError):
+            profiler.configure("cprofile", {"/api/v1/server/list_all": 2})
+
+    def test_configure_bad_mode(self):
+        profiler = Request_profiler(hello_app)
+        with self.assertRaises(ValueError):
+            profiler.configure("perf")
+
+if __name__ == '__main__':
+    unittest.main()
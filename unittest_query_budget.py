@@ -0,0 +1,126 @@
+from app.wireguard_db import Wireguard_database
+from contextlib import contextmanager
+import unittest, importlib.util, os, sys, tempfile, base64
+
+def load_api():
+    """ Imports app/app.py, which reads its settings from the environment, against the local test database. """
+    app_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app")
+    secrets = tempfile.mkdtemp()
+    for name, value in (("db_password", "changeme123"), ("api_password", "changeme123")):
+        with open(os.path.join(secrets, name), "w") as secret_file:
+            secret_file.write(value)
+    os.environ.update({"DB_SERVER": "127.0.0.1", "DB_PORT": "5432", "DB_NAME": "postgres", "DB_USER": "postgres", "API_USER": "admin",
+        "DB_PASSWORD_PATH": os.path.join(secrets, "db_password"), "API_PASSWORD_PATH": os.path.join(secrets, "api_password")})
+    sys.path.insert(0, app_directory)
+    spec = importlib.util.spec_from_file_location("wireguard_api", os.path.join(app_directory, "app.py"))
+    api = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(api)
+    return api
+
+class Query_budget_test_case(unittest.TestCase):
+    """
+    Adds assertions that a block of code stays within a budget of database round trips and commits.
+    Budgets are maximums, so lowering the work done never fails a test, but any increase does.
+    """
+    @contextmanager
+    def assertQueryBudget(self, wireguard_state, queries, commits):
+        with wireguard_state.track_queries() as stats:
+            yield stats
+        self.assertTrue(stats.queries <= queries and stats.commits <= commits, f"{stats.queries} queries and {stats.commits} commits, budget is {queries} queries and {commits} commits.")
+
+    def assertResponseBudget(self, response, queries, commits):
+        used = (int(response.headers['X-DB-Queries']), int(response.headers['X-DB-Commits']))
+        self.assertTrue(used[0] <= queries and used[1] <= commits, f"{used[0]} queries and {used[1]} commits, budget is {queries} queries and {commits} commits.")
+
+class unittest_query_budget(Query_budget_test_case):
+
+    def setUp(self):
+        self.wireguard_state = Wireguard_database()
+        self.wireguard_state.create_server("wireguard01", "192.168.2.0", 24, "gjXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=", "192.168.2.55", 5128, 20, "192.168.2.0/32")
+
+    def tearDown(self):
+        self.wireguard_state.delete_server("wireguard01")
+
+    def test_budget_create_server(self):
+        with self.assertQueryBudget(self.wireguard_state, queries=2, commits=2):
+            self.wireguard_state.create_server("wireguard02", "192.168.3.0", 24, "gjXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXd=", "192.168.2.56", 5128, 20, "192.168.3.0/32")
+        self.wireguard_state.delete_server("wireguard02")
+
+    def test_budget_create_client(self):
+        with self.assertQueryBudget(self.wireguard_state, queries=4, commits=1):
+            self.wireguard_state.create_client("testclient01", "wireguard01", "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=")
+
+    def test_budget_create_client_unchanged(self):
+        self.wireguard_state.create_client("testclient01", "wireguard01", "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=")
+        with self.assertQueryBudget(self.wireguard_state, queries=1, commits=0):
+            self.wireguard_state.create_client("testclient01", "wireguard01", "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=")
+
+    def test_budget_create_client_new_key(self):
+        self.wireguard_state.create_client("testclient01", "wireguard01", "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=")
+        with self.assertQueryBudget(self.wireguard_state, queries=2, commits=1):
+            self.wireguard_state.create_client("testclient01", "wireguard01", "YxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=")
+
+    def test_budget_delete_client_peering(self):
+        self.wireguard_state.create_client("testclient01", "wireguard01", "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=")
+        with self.assertQueryBudget(self.wireguard_state, queries=1, commits=1):
+            self.wireguard_state.delete_client_peering("testclient01", "wireguard01")
+
+    def test_budget_get_server_config(self):
+        self.wireguard_state.create_client("testclient01", "wireguard01", "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=")
+        with self.assertQueryBudget(self.wireguard_state, queries=3, commits=0):
+            self.wireguard_state.get_server_config("wireguard01")
+
+    def test_budget_get_client_config(self):
+        self.wireguard_state.create_client("testclient01", "wireguard01", "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=")
+        with self.assertQueryBudget(self.wireguard_state, queries=5, commits=0):
+            self.wireguard_state.get_client_config("testclient01", "wireguard01")
+
+    def test_budget_search_clients(self):
+        with self.assertQueryBudget(self.wireguard_state, queries=1, commits=0):
+            self.wireguard_state.search_clients(address="192.168.2.0/24")
+
+    def test_budget_get_capacity(self):
+        with self.assertQueryBudget(self.wireguard_state, queries=1, commits=0):
+            self.wireguard_state.get_capacity()
+
+    def test_budget_reap_expired_peers(self):
+        with self.assertQueryBudget(self.wireguard_state, queries=1, commits=1):
+            self.wireguard_state.reap_expired_peers()
+
+class unittest_route_query_budget(Query_budget_test_case):
+
+    @classmethod
+    def setUpClass(cls):
+        #The API only prepares the database when run directly, so make sure it is formatted and migrated.
+        Wireguard_database().close()
+        cls.api = load_api()
+        cls.client = cls.api.app.test_client()
+        cls.headers = {"Authorization": "Basic " + base64.b64encode(b"admin:changeme123").decode()}
+
+    def setUp(self):
+        self.client.post("/api/v1/server/add/", headers=self.headers, json={"server_name": "wireguard01", "network_address": "192.168.2.0", "network_mask": 24,
+            "public_key": "gjXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=", "endpoint_address": "192.168.2.55", "endpoint_port": 5128, "n_reserved_ips": 20, "allowed_ips": "192.168.2.0/32"})
+
+    def tearDown(self):
+        self.client.post("/api/v1/server/delete/", headers=self.headers, json={"server_name": "wireguard01"})
+
+    def test_budget_route_client_add(self):
+        response = self.client.post("/api/v1/client/add/", headers=self.headers, json={"client_name": "testclient01", "server_name": "wireguard01", "public_key": "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc="})
+        self.assertResponseBudget(response, queries=4, commits=1)
+
+    def test_budget_route_remove_peer(self):
+        self.client.post("/api/v1/client/add/", headers=self.headers, json={"client_name": "testclient01", "server_name": "wireguard01", "public_key": "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc="})
+        response = self.client.post("/api/v1/server/remove_peer/", headers=self.headers, json={"client_name": "testclient01", "server_name": "wireguard01"})
+        self.assertResponseBudget(response, queries=1, commits=1)
+
+    def test_budget_route_server_config(self):
+        response = self.client.get("/api/v1/server/config/", headers=self.headers, json={"server_name": "wireguard01"})
+        self.assertResponseBudget(response, queries=4, commits=0)
+
+    def test_budget_route_client_config(self):
+        self.client.post("/api/v1/client/add/", headers=self.headers, json={"client_name": "testclient01", "server_name": "wireguard01", "public_key": "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc="})
+        response = self.client.get("/api/v1/client/config/", json={"client_name": "testclient01", "server_name": "wireguard01"})
+        self.assertResponseBudget(response, queries=5, commits=0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+from app.wireguard_agent import Wireguard_agent
+import unittest, tempfile, os, stat
+
+DUMP = (
+    "cHJpdmF0ZWtleXByaXZhdGVrZXlwcml2YXRla2V5cHI=\tgjXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=\t5128\toff\n"
+    "gjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=\t(none)\t10.0.0.2:51820\t192.168.2.21/32\t1600000000\t100\t200\toff\n"
+    "xjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=\t(none)\t(none)\t192.168.2.30/32\t0\t0\t0\toff\n"
+    "zjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=\t(none)\t(none)\t(none)\t0\t0\t0\toff\n"
+)
+
+class fake_runner():
+    def __init__(self, dump):
+        self.dump = dump
+        self.commands = []
+
+    def __call__(self, args):
+        self.commands.append(args)
+        if args[1] == "show":
+            return self.dump
+        return ""
+
+class unittest_wireguard_agent(unittest.TestCase):
+
+    def create_agent(self, desired_peers, runner):
+        agent = Wireguard_agent("http://127.0.0.1:5000", "wireguard01", "wg0", runner=runner)
+        agent.fetch_peers = lambda: desired_peers
+        return agent
+
+    def test_read_interface(self):
+        agent = self.create_agent({}, fake_runner(DUMP))
+        expected = {
+            "gjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=": {"192.168.2.21/32"},
+            "xjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=": {"192.168.2.30/32"},
+            "zjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=": set()
+        }
+        self.assertEqual(expected, agent.read_interface())
+
+    def test_reconcile_minimal_diff(self):
+        desired_peers = {
+            "gjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=": {"192.168.2.21/32"},
+            "xjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=": {"192.168.2.22/32"},
+            "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=": {"192.168.2.23/32"}
+        }
+        runner = fake_runner(DUMP)
+        result = self.create_agent(desired_peers, runner).reconcile()
+        expected_command = ["wg", "set", "wg0",
+            "peer", "zjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=", "remove",
+            "peer", "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=", "allowed-ips", "192.168.2.23/32",
+            "peer", "xjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=", "allowed-ips", "192.168.2.22/32"]
+        self.assertEqual((3, expected_command), (result, runner.commands[-1]))
+
+    def test_reconcile_up_to_date(self):
+        desired_peers = {
+            "gjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=": {"192.168.2.21/32"},
+            "xjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=": {"192.168.2.30/32"},
+            "zjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=": set()
+        }
+        runner = fake_runner(DUMP)
+        result = self.create_agent(desired_peers, runner).reconcile()
+        self.assertEqual((0, 1), (result, len(runner.commands)))
+
+    def test_reconcile_fake_wg_binary(self):
+        with tempfile.TemporaryDirectory() as directory:
+            dump_path = os.path.join(directory, "dump")
+            log_path = os.path.join(directory, "log")
+            wg_path = os.path.join(directory, "wg")
+            with open(dump_path, "w") as dump_file:
+                dump_file.write(DUMP)
+            with open(wg_path, "w") as wg_file:
+                wg_file.write(f"#!/bin/sh\nif [ \"$1\" = show ]; then cat {dump_path}; else echo \"$@\" >> {log_path}; fi\n")
+            os.chmod(wg_path, os.stat(wg_path).st_mode | stat.S_IEXEC)
+            agent = Wireguard_agent("http://127.0.0.1:5000", "wireguard01", "wg0", wg_binary=wg_path)
+            agent.fetch_peers = lambda: {"gjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=": {"192.168.2.21/32"}}
+            agent.reconcile()
+            with open(log_path) as log_file:
+                result = log_file.read()
+        expected = "set wg0 peer xjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc= remove peer zjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc= remove\n"
+        self.assertEqual(expected, result)
+
+    def test_reconcile_large_peer_set(self):
+        desired_peers = {f"{index:042d}A=": {f"10.{index // 65536}.{index // 256 % 256}.{index % 256}/32"} for index in range(20000)}
+        with tempfile.TemporaryDirectory() as directory:
+            log_path = os.path.join(directory, "log")
+            wg_path = os.path.join(directory, "wg")
+            with open(wg_path, "w") as wg_file:
+                wg_file.write(f"#!/bin/sh\nif [ \"$1\" = show ]; then echo; else echo \"$@\" >> {log_path}; fi\n")
+            os.chmod(wg_path, os.stat(wg_path).st_mode | stat.S_IEXEC)
+            agent = Wireguard_agent("http://127.0.0.1:5000", "wireguard01", "wg0", wg_binary=wg_path)
+            agent.fetch_peers = lambda: desired_peers
+            result = agent.reconcile()
+            with open(log_path) as log_file:
+                calls = log_file.read().splitlines()
+        applied_peers = sum(call.count(" allowed-ips ") for call in calls)
+        self.assertEqual((20000, 20000, True), (result, applied_peers, len(calls) > 1))
+
+if __name__ == '__main__':
+    unittest.main()
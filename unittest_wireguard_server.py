@@ -1,5 +1,5 @@
 from app.wireguard_db import Wireguard_database
-import unittest
+import unittest, io, threading
 
 class unittest_wireguard_server(unittest.TestCase):      
     
@@ -204,5 +204,274 @@ class unittest_wireguard_server(unittest.TestCase):
         wireguard_state.delete_server("wireguard01")
         self.assertEqual(True, result)
 
+    def test_snapshot_round_trip(self):
+        expected_result = { 
+            "peers": [
+                { 
+                    "ip_address": "192.168.2.21",
+                    "public_key": "gjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc="
+                }
+            ]
+        }
+
+        wireguard_state = Wireguard_database()
+        wireguard_state.create_server("wireguard01", "192.168.2.0", 24, "gjXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=", "192.168.2.55", 5128, 20, "192.168.2.0/32")
+        wireguard_state.create_client("testclient1", "wireguard01", "gjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=")
+        snapshot = io.BytesIO()
+        export_result = wireguard_state.export_snapshot(snapshot)
+        wireguard_state.delete_server("wireguard01")
+        snapshot.seek(0)
+        import_result = wireguard_state.import_snapshot(snapshot)
+        result = wireguard_state.get_server_config("wireguard01")
+        wireguard_state.delete_server("wireguard01")
+        self.assertEqual((200, 200, expected_result), (export_result, import_result, result))
+
+    def test_snapshot_import_notifies_all_servers(self):
+        listener_state = Wireguard_database()
+        listener_state.listen_for_config_changes()
+        wireguard_state = Wireguard_database()
+        wireguard_state.create_server("wireguard01", "192.168.2.0", 24, "gjXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=", "192.168.2.55", 5128, 20, "192.168.2.0/32")
+        snapshot = io.BytesIO()
+        wireguard_state.export_snapshot(snapshot)
+        snapshot.seek(0)
+        listener_state.poll_config_changes(0.1)
+        wireguard_state.import_snapshot(snapshot)
+        changed_servers = listener_state.poll_config_changes(5)
+        wireguard_state.delete_server("wireguard01")
+        listener_state.close()
+        self.assertIn(None, changed_servers)
+
+    def test_snapshot_import_truncated(self):
+        wireguard_state = Wireguard_database()
+        wireguard_state.create_server("wireguard01", "192.168.2.0", 24, "gjXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=", "192.168.2.55", 5128, 20, "192.168.2.0/32")
+        result = wireguard_state.import_snapshot(io.BytesIO(b"servers serverID,public_key,endpoint_address,endpoint_port\nwireguard02\tgjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=\t192.168.2.56\t5128\n"))
+        exists = wireguard_state.check_server_exists("wireguard01")
+        wireguard_state.delete_server("wireguard01")
+        self.assertEqual((400, True), (result, exists))
+
+    def test_reap_expired_peers(self):
+        wireguard_state = Wireguard_database()
+        wireguard_state.create_server("wireguard01", "192.168.2.0", 24, "gjXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=", "192.168.2.55", 5128, 20, "192.168.2.0/32", 60)
+        wireguard_state.create_client("testclient01", "wireguard01", "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=")
+        wireguard_state.cursor.execute("UPDATE clients SET last_seen = now() - interval '1 hour';")
+        wireguard_state.db_connection.commit()
+        result = wireguard_state.reap_expired_peers()
+        config = wireguard_state.get_server_config("wireguard01")
+        wireguard_state.delete_server("wireguard01")
+        self.assertEqual((1, {"peers": []}), (result, config))
+
+    def test_reap_expired_peers_no_ttl(self):
+        wireguard_state = Wireguard_database()
+        wireguard_state.create_server("wireguard01", "192.168.2.0", 24, "gjXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=", "192.168.2.55", 5128, 20, "192.168.2.0/32")
+        wireguard_state.create_client("testclient01", "wireguard01", "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=")
+        wireguard_state.cursor.execute("UPDATE clients SET last_seen = now() - interval '1 hour';")
+        wireguard_state.db_connection.commit()
+        result = wireguard_state.reap_expired_peers()
+        exists = wireguard_state.check_client_exists("testclient01", "wireguard01")
+        wireguard_state.delete_server("wireguard01")
+        self.assertEqual((0, True), (result, exists))
+
+    def test_reap_expired_peers_connection_lost(self):
+        wireguard_state = Wireguard_database()
+        wireguard_state.close()
+        result = wireguard_state.reap_expired_peers()
+        self.assertEqual(None, result)
+
+    def test_client_config_no_ttl_not_touched(self):
+        wireguard_state = Wireguard_database()
+        wireguard_state.create_server("wireguard01", "192.168.2.0", 24, "gjXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=", "192.168.2.55", 5128, 20, "192.168.2.0/32")
+        wireguard_state.create_client("testclient01", "wireguard01", "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=")
+        result = wireguard_state.touch_client("testclient01", "wireguard01", expiring_only=True)
+        wireguard_state.delete_server("wireguard01")
+        self.assertEqual(404, result)
+
+    def test_touch_client_keeps_peer(self):
+        wireguard_state = Wireguard_database()
+        wireguard_state.create_server("wireguard01", "192.168.2.0", 24, "gjXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=", "192.168.2.55", 5128, 20, "192.168.2.0/32", 60)
+        wireguard_state.create_client("testclient01", "wireguard01", "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=")
+        wireguard_state.cursor.execute("UPDATE clients SET last_seen = now() - interval '1 hour';")
+        wireguard_state.db_connection.commit()
+        result = wireguard_state.touch_client("testclient01", "wireguard01")
+        wireguard_state.reap_expired_peers()
+        exists = wireguard_state.check_client_exists("testclient01", "wireguard01")
+        wireguard_state.delete_server("wireguard01")
+        self.assertEqual((200, True), (result, exists))
+
+    def test_set_peer_ttl_nonexistent(self):
+        wireguard_state = Wireguard_database()
+        result = wireguard_state.set_peer_ttl("wireguard01", 60)
+        self.assertEqual(404, result)
+
+    def test_config_revision_bumped(self):
+        wireguard_state = Wireguard_database()
+        wireguard_state.create_server("wireguard01", "192.168.2.0", 24, "gjXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=", "192.168.2.55", 5128, 20, "192.168.2.0/32")
+        before = wireguard_state.get_server_config_revision("wireguard01")
+        wireguard_state.create_client("testclient01", "wireguard01", "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=")
+        after = wireguard_state.get_server_config_revision("wireguard01")
+        wireguard_state.delete_server("wireguard01")
+        self.assertLess(before, after)
+
+    def test_search_clients_public_key(self):
+        expected = {
+            "clients": [
+                {
+                    "client_name": "testclient2",
+                    "server": "wireguard01",
+                    "public_key": "xjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=",
+                    "ip_address": "192.168.2.22"
+                }
+            ]
+        }
+        wireguard_state = Wireguard_database()
+        wireguard_state.create_server("wireguard01", "192.168.2.0", 24, "gjXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=", "192.168.2.55", 5128, 20, "192.168.2.0/32")
+        wireguard_state.create_client("testclient1", "wireguard01", "gjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=")
+        wireguard_state.create_client("testclient2", "wireguard01", "xjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=")
+        result = wireguard_state.search_clients(public_key="xjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=")
+        wireguard_state.delete_server("wireguard01")
+        for client in result["clients"]:
+            client.pop("peering")
+        self.assertEqual(expected, result)
+
+    def test_search_clients_address(self):
+        wireguard_state = Wireguard_database()
+        wireguard_state.create_server("wireguard01", "192.168.2.0", 24, "gjXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=", "192.168.2.55", 5128, 20, "192.168.2.0/32")
+        wireguard_state.create_client("testclient1", "wireguard01", "gjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=")
+        wireguard_state.create_client("testclient2", "wireguard01", "xjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=")
+        single = wireguard_state.search_clients(address="192.168.2.21")
+        network = wireguard_state.search_clients(address="192.168.2.0/24")
+        wireguard_state.delete_server("wireguard01")
+        self.assertEqual((["testclient1"], ["testclient1", "testclient2"]), ([client["client_name"] for client in single["clients"]], [client["client_name"] for client in network["clients"]]))
+
+    def test_search_clients_name_prefix(self):
+        wireguard_state = Wireguard_database()
+        wireguard_state.create_server("wireguard01", "192.168.2.0", 24, "gjXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=", "192.168.2.55", 5128, 20, "192.168.2.0/32")
+        wireguard_state.create_client("test_client1", "wireguard01", "gjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=")
+        wireguard_state.create_client("testxclient2", "wireguard01", "xjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=")
+        result = wireguard_state.search_clients(client_name_prefix="test_", server_name="wireguard01")
+        wireguard_state.delete_server("wireguard01")
+        self.assertEqual(["test_client1"], [client["client_name"] for client in result["clients"]])
+
+    def test_search_clients_bad_address(self):
+        wireguard_state = Wireguard_database()
+        result = wireguard_state.search_clients(address="192.168.2")
+        self.assertEqual(None, result)
+
+    def test_search_clients_no_filters(self):
+        wireguard_state = Wireguard_database()
+        result = wireguard_state.search_clients()
+        self.assertEqual(None, result)
+
+    def test_capacity_expected(self):
+        expected = {
+            "wireguard01": {
+                "subnet": "192.168.2.0/24",
+                "used": 1,
+                "free": 233,
+                "reserved": 22,
+                "high_water": 2
+            }
+        }
+        wireguard_state = Wireguard_database()
+        wireguard_state.create_server("wireguard01", "192.168.2.0", 24, "gjXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=", "192.168.2.55", 5128, 20, "192.168.2.0/32")
+        wireguard_state.create_client("testclient1", "wireguard01", "gjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=")
+        wireguard_state.create_client("testclient2", "wireguard01", "xjXsuVSwfiqiZkf/rcEV8KszlTF4BseS4zY6dnKjCXc=")
+        wireguard_state.delete_client_peering("testclient1", "wireguard01")
+        result = wireguard_state.get_capacity("wireguard01")
+        wireguard_state.delete_server("wireguard01")
+        self.assertEqual(expected, result)
+
+    def test_capacity_nonexistent(self):
+        wireguard_state = Wireguard_database()
+        result = wireguard_state.get_capacity("wireguard01")
+        self.assertEqual(None, result)
+
+    def test_client_create_repeated(self):
+        wireguard_state = Wireguard_database()
+        wireguard_state.create_server("wireguard01", "192.168.2.0", 24, "gjXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=", "192.168.2.55", 5128, 20, "192.168.2.0/32")
+        wireguard_state.create_client("testclient01", "wireguard01", "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=")
+        clientID = wireguard_state.get_client_id("testclient01", "wireguard01")
+        revision = wireguard_state.get_server_config_revision("wireguard01")
+        result = wireguard_state.upsert_client("testclient01", "wireguard01", "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=")
+        unchanged = (clientID, revision) == (wireguard_state.get_client_id("testclient01", "wireguard01"), wireguard_state.get_server_config_revision("wireguard01"))
+        wireguard_state.delete_server("wireguard01")
+        self.assertEqual(((200, "192.168.2.21"), True), (result, unchanged))
+
+    def test_client_create_new_key_keeps_lease(self):
+        expected_result = { 
+            "peers": [
+                { 
+                    "ip_address": "192.168.2.21",
+                    "public_key": "YxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc="
+                }
+            ]
+        }
+        wireguard_state = Wireguard_database()
+        wireguard_state.create_server("wireguard01", "192.168.2.0", 24, "gjXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=", "192.168.2.55", 5128, 20, "192.168.2.0/32")
+        wireguard_state.create_client("testclient01", "wireguard01", "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=")
+        revision = wireguard_state.get_server_config_revision("wireguard01")
+        result = wireguard_state.upsert_client("testclient01", "wireguard01", "YxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=")
+        config = wireguard_state.get_server_config("wireguard01")
+        bumped = wireguard_state.get_server_config_revision("wireguard01") > revision
+        wireguard_state.delete_server("wireguard01")
+        self.assertEqual(((200, "192.168.2.21"), expected_result, True), (result, config, bumped))
+
+    def upsert_concurrently(self, peerings):
+        connections = [Wireguard_database() for peering in peerings]
+        barrier = threading.Barrier(len(peerings))
+        results = [None] * len(peerings)
+        def upsert(index):
+            barrier.wait()
+            results[index] = connections[index].upsert_client(*peerings[index])
+        threads = [threading.Thread(target=upsert, args=(index,)) for index in range(len(peerings))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for connection in connections:
+            connection.close()
+        return results
+
+    def test_client_create_concurrent_new_peers(self):
+        wireguard_state = Wireguard_database()
+        wireguard_state.create_server("wireguard01", "192.168.2.0", 24, "gjXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=", "192.168.2.55", 5128, 20, "192.168.2.0/32")
+        results = self.upsert_concurrently([
+            ("testclient01", "wireguard01", "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc="),
+            ("testclient02", "wireguard01", "YxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc="),
+            ("testclient03", "wireguard01", "ZxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=")])
+        wireguard_state.delete_server("wireguard01")
+        self.assertEqual(([201, 201, 201], 3), ([result[0] for result in results], len(set(result[1] for result in results))))
+
+    def test_client_create_concurrent_retries(self):
+        wireguard_state = Wireguard_database()
+        wireguard_state.create_server("wireguard01", "192.168.2.0", 24, "gjXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=", "192.168.2.55", 5128, 20, "192.168.2.0/32")
+        results = self.upsert_concurrently([("testclient01", "wireguard01", "XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=")] * 3)
+        peers = wireguard_state.get_server_config("wireguard01")["peers"]
+        wireguard_state.delete_server("wireguard01")
+        self.assertEqual(([200, 200, 201], [(201, "192.168.2.21")], 1), (sorted(result[0] for result in results), [result for result in results if result[0] == 201], len(peers)))
+
+    def test_migrate_keeps_latest_duplicate_peering(self):
+        wireguard_state = Wireguard_database()
+        wireguard_state.create_server("wireguard01", "192.168.2.0", 24, "gjXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=", "192.168.2.55", 5128, 20, "192.168.2.0/32")
+        #Recreate a database from before the unique index, holding an old and a newer enrolment of the same peering.
+        wireguard_state.cursor.execute("DROP INDEX clients_serverID_client_name_idx; DELETE FROM schema_version;")
+        wireguard_state.cursor.execute("INSERT INTO clients (client_name, public_key, serverID) VALUES ('testclient01', 'XxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=', 'wireguard01'), ('testclient01', 'YxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=', 'wireguard01');")
+        wireguard_state.db_connection.commit()
+        result = wireguard_state.migrate_database()
+        wireguard_state.cursor.execute("SELECT public_key FROM clients WHERE client_name = 'testclient01';")
+        public_keys = wireguard_state.cursor.fetchall()
+        wireguard_state.delete_server("wireguard01")
+        self.assertEqual((True, [("YxXnuVSwfiqiZkf/rcEV8KczlTF4BseS4zY6dnKjCXc=",)]), (result, public_keys))
+
+    def test_migrate_current_schema_skips_locks(self):
+        #An open read transaction blocks any ALTER TABLE, so connecting must not attempt one once the schema is current.
+        reader_state = Wireguard_database()
+        reader_state.list_servers()
+        wireguard_state = Wireguard_database()
+        version = wireguard_state.get_schema_version()
+        result = wireguard_state.migrate_database()
+        wireguard_state.close()
+        reader_state.close()
+        self.assertEqual((Wireguard_database.schema_version, True), (version, result))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
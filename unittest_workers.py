@@ -0,0 +1,108 @@
+from app.workers import Config_cache, Connection_pool, serve_workers
+import unittest, os, signal, socket, tempfile, threading, time
+
+class unittest_workers(unittest.TestCase):
+
+    def test_config_cache_disabled(self):
+        cache = Config_cache()
+        cache.put("wireguard01", {"peers": []}, cache.generation())
+        self.assertEqual(None, cache.get("wireguard01"))
+
+    def test_config_cache_expected(self):
+        cache = Config_cache()
+        cache.enable()
+        cache.put("wireguard01", {"peers": []}, cache.generation())
+        self.assertEqual({"peers": []}, cache.get("wireguard01"))
+
+    def test_config_cache_invalidate(self):
+        cache = Config_cache()
+        cache.enable()
+        cache.put("wireguard01", {"peers": []}, cache.generation())
+        cache.put("wireguard02", {"peers": []}, cache.generation())
+        cache.invalidate("wireguard01")
+        self.assertEqual((None, {"peers": []}), (cache.get("wireguard01"), cache.get("wireguard02")))
+
+    def test_config_cache_stale_put(self):
+        cache = Config_cache()
+        cache.enable()
+        generation = cache.generation()
+        cache.invalidate("wireguard01")
+        cache.put("wireguard01", {"peers": []}, generation)
+        self.assertEqual(None, cache.get("wireguard01"))
+
+    def test_connection_pool_per_thread(self):
+        pool = Connection_pool(lambda: threading.get_ident())
+        results = []
+        thread = threading.Thread(target=lambda: results.append(pool.connection()))
+        thread.start()
+        thread.join()
+        self.assertEqual((threading.get_ident(), thread.ident), (pool.connection(), results[0]))
+
+    def test_connection_pool_discard(self):
+        class fake_connection():
+            closed = False
+            def close(self):
+                self.closed = True
+        pool = Connection_pool(fake_connection)
+        first = pool.connection()
+        pool.discard()
+        self.assertEqual((True, None, False), (first.closed, pool.current(), pool.connection() is first))
+
+    def test_connection_pool_bounded(self):
+        pool = Connection_pool(object, size=1, timeout=0.01)
+        first = pool.connection()
+        results = []
+        def borrow():
+            try:
+                pool.connection()
+            except TimeoutError:
+                results.append("timeout")
+        thread = threading.Thread(target=borrow)
+        thread.start()
+        thread.join()
+        pool.release()
+        thread = threading.Thread(target=lambda: results.append(pool.connection() is first))
+        thread.start()
+        thread.join()
+        self.assertEqual(["timeout", True], results)
+
+    def test_connection_pool_failed_factory(self):
+        def factory():
+            raise Exception("Unreachable")
+        pool = Connection_pool(factory)
+        with self.assertRaises(Exception):
+            pool.connection()
+        self.assertEqual(None, pool.current())
+
+    def test_serve_workers_restarts_crashed_worker(self):
+        with tempfile.TemporaryDirectory() as directory:
+            log_path = os.path.join(directory, "log")
+            with socket.socket() as probe:
+                probe.bind(("127.0.0.1", 0))
+                port = probe.getsockname()[1]
+
+            def serve_worker(listening_socket, worker_index):
+                with open(log_path, "a") as log_file:
+                    log_file.write(f"{worker_index}\n")
+                if worker_index == 0 and not os.path.exists(log_path + ".crashed"):
+                    open(log_path + ".crashed", "w").close()
+                    raise Exception("crash")
+                time.sleep(30)
+
+            supervisor = os.fork()
+            if supervisor == 0:
+                serve_workers(serve_worker, "127.0.0.1", port, 2, restart_delay=0)
+                os._exit(0)
+            deadline = time.time() + 10
+            starts = []
+            while len(starts) < 3 and time.time() < deadline:
+                time.sleep(0.05)
+                if os.path.exists(log_path):
+                    with open(log_path) as log_file:
+                        starts = log_file.read().split()
+            os.kill(supervisor, signal.SIGTERM)
+            _, status = os.waitpid(supervisor, 0)
+        self.assertEqual((["0", "0", "1"], 0), (sorted(starts), status))
+
+if __name__ == '__main__':
+    unittest.main()